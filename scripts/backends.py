@@ -0,0 +1,459 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from scripts import telemetry
+
+BACKENDS = ['ollama', 'openai', 'llamacpp']
+
+DEFAULT_HOSTS = {
+    'ollama': 'http://127.0.0.1:18199',
+    'openai': 'http://127.0.0.1:8080',
+}
+
+
+class OllamaBackend:
+    """
+    Backend for an Ollama server. The underlying HTTP client keeps its
+    connections open between requests.
+    """
+
+    def __init__(self, host, timeout=None, keep_alive=None):
+        import ollama
+        self.host = host
+        self.keep_alive = keep_alive
+        self._client = ollama.Client(host=host, timeout=timeout)
+
+    def chat(self, model, messages, options=None, format=None):
+        """
+        Function to send a chat request and return the Ollama response.
+        """
+        chat_kwargs = {}
+        if format is not None:
+            chat_kwargs["format"] = format
+        # Every request resets how long the model stays loaded, so keep the warm-up's setting
+        if self.keep_alive is not None:
+            chat_kwargs["keep_alive"] = self.keep_alive
+        response = self._client.chat(model=model, messages=messages, options=options, **chat_kwargs)
+        # Newer versions of the ollama library return a response object
+        if hasattr(response, 'model_dump'):
+            response = response.model_dump()
+        return response
+
+    def load(self, model):
+        """
+        Function to load a model into memory before its requests are sent.
+        An empty generate request only loads the model. Returns the response.
+        """
+        response = self._client.generate(model=model, prompt='', keep_alive=self.keep_alive)
+        if hasattr(response, 'model_dump'):
+            response = response.model_dump()
+        return response
+
+    def health(self):
+        """
+        Function to check that the server is up.
+        """
+        try:
+            self._client.list()
+            return True
+        except Exception:
+            return False
+
+
+class OpenAIBackend:
+    """
+    Backend for any server with an OpenAI-compatible chat completions API,
+    e.g. the llama.cpp server or vLLM. Responses are converted to the Ollama
+    response format so the rest of the pipeline does not need to know which
+    backend is in use.
+    """
+
+    def __init__(self, host, timeout=None, api_key=None):
+        import httpx
+        self.host = host.rstrip('/')
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        # A single client keeps connections alive between requests
+        self._client = httpx.Client(
+            base_url=self.host,
+            headers=headers,
+            timeout=timeout,
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=64),
+        )
+
+    def chat(self, model, messages, options=None, format=None):
+        """
+        Function to send a chat request and return it in the Ollama response format.
+        """
+        payload = {"model": model, "messages": messages}
+        if options and "temperature" in options:
+            payload["temperature"] = options["temperature"]
+        if isinstance(format, dict):
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "output", "schema": format},
+            }
+        elif format == 'json':
+            payload["response_format"] = {"type": "json_object"}
+        response = self._client.post("/v1/chat/completions", json=payload)
+        response.raise_for_status()
+        completion = response.json()
+        usage = completion.get("usage") or {}
+        return {
+            "model": completion.get("model", model),
+            "message": completion["choices"][0]["message"],
+            "prompt_eval_count": usage.get("prompt_tokens"),
+            "eval_count": usage.get("completion_tokens"),
+        }
+
+    def health(self):
+        """
+        Function to check that the server is up.
+        """
+        try:
+            return self._client.get("/v1/models").status_code == 200
+        except Exception:
+            return False
+
+
+class LlamaCppBackend:
+    """
+    Backend running a GGUF model in-process with llama-cpp-python, so there
+    is no HTTP hop. The model is loaded once; the model name passed to chat
+    is ignored. llama.cpp contexts are not thread-safe, so requests are run
+    one at a time.
+    """
+
+    def __init__(self, model_path, n_ctx=8192, n_gpu_layers=-1):
+        from llama_cpp import Llama
+        self.host = model_path
+        self._llm = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
+        self._lock = threading.Lock()
+
+    def chat(self, model, messages, options=None, format=None):
+        """
+        Function to run a chat request and return it in the Ollama response format.
+        """
+        chat_kwargs = {}
+        if options and "temperature" in options:
+            chat_kwargs["temperature"] = options["temperature"]
+        if isinstance(format, dict):
+            chat_kwargs["response_format"] = {"type": "json_object", "schema": format}
+        elif format == 'json':
+            chat_kwargs["response_format"] = {"type": "json_object"}
+        with self._lock:
+            completion = self._llm.create_chat_completion(messages=messages, **chat_kwargs)
+        usage = completion.get("usage") or {}
+        return {
+            "model": model,
+            "message": completion["choices"][0]["message"],
+            "prompt_eval_count": usage.get("prompt_tokens"),
+            "eval_count": usage.get("completion_tokens"),
+        }
+
+    def health(self):
+        """
+        Function to check that the backend is up. The model is in-process, so it always is.
+        """
+        return True
+
+
+class Endpoint:
+    """
+    One server behind a LoadBalancedBackend, with its request bookkeeping.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.outstanding = 0
+        self.calls = 0
+        self.failures = 0
+        self.down_until = 0
+
+
+class LoadBalancedBackend:
+    """
+    Backend spreading requests over several servers. Each request goes to
+    the healthy endpoint with the fewest requests in flight. An endpoint that
+    fails a health check or a request is skipped for retry_after seconds and
+    the request is retried on another endpoint. With hedge=True, a request
+    still running after the p95 latency is duplicated on a second endpoint
+    and whichever answer arrives first is used.
+    """
+
+    def __init__(self, backends, hedge=False, retry_after=30, min_samples=20):
+        self.endpoints = [Endpoint(backend) for backend in backends]
+        self.hedge = hedge
+        self.retry_after = retry_after
+        self.min_samples = min_samples
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=500)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=64) if hedge else None
+        # Check every endpoint before the first request
+        for endpoint in self.endpoints:
+            if not endpoint.backend.health():
+                logging.error(f"Endpoint {endpoint.backend.host} failed its health check")
+                endpoint.down_until = time.time() + self.retry_after
+        self.host = ",".join(endpoint.backend.host for endpoint in self.endpoints)
+
+    def _acquire(self, exclude=()):
+        """
+        Function to pick the healthy endpoint with the fewest requests in flight.
+        If every endpoint is down, the one that will recover first is used.
+        """
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if e.down_until <= time.time()]
+            if healthy:
+                # Ties go to the endpoint that has served the fewest requests
+                endpoint = min(healthy, key=lambda e: (e.outstanding, e.calls))
+            else:
+                endpoint = min(candidates, key=lambda e: e.down_until)
+            endpoint.outstanding += 1
+            endpoint.calls += 1
+            return endpoint
+
+    def _call(self, endpoint, request):
+        """
+        Function to send a request to one endpoint and record its latency.
+        """
+        start = time.perf_counter()
+        try:
+            response = endpoint.backend.chat(**request)
+        except Exception:
+            with self._lock:
+                endpoint.failures += 1
+                endpoint.down_until = time.time() + self.retry_after
+            raise
+        finally:
+            with self._lock:
+                endpoint.outstanding -= 1
+        with self._lock:
+            self._latencies.append(time.perf_counter() - start)
+        response["endpoint"] = endpoint.backend.host
+        return response
+
+    def p95_latency(self):
+        """
+        Function to return the p95 latency of recent requests, once enough are recorded.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def _chat_hedged(self, endpoint, request):
+        """
+        Function to send a request, duplicating it on a second endpoint if it
+        takes longer than the p95 latency.
+        """
+        threshold = self.p95_latency()
+        if not self.hedge or threshold is None or len(self.endpoints) < 2:
+            return self._call(endpoint, request)
+        primary = self._pool.submit(self._call, endpoint, request)
+        try:
+            return primary.result(timeout=threshold)
+        except FuturesTimeoutError:
+            pass
+        backup_endpoint = self._acquire(exclude=[endpoint])
+        if backup_endpoint is None:
+            return primary.result()
+        backup = self._pool.submit(self._call, backup_endpoint, request)
+        with self._lock:
+            self.hedged += 1
+        error = None
+        for future in as_completed([primary, backup]):
+            try:
+                response = future.result()
+            except Exception as e:
+                error = e
+                continue
+            response["hedged"] = True
+            if future is backup:
+                with self._lock:
+                    self.hedge_wins += 1
+            return response
+        raise error
+
+    def chat(self, model, messages, options=None, format=None):
+        """
+        Function to send a chat request, failing over to other endpoints on errors.
+        """
+        request = {"model": model, "messages": messages, "options": options, "format": format}
+        tried = []
+        error = None
+        while True:
+            endpoint = self._acquire(exclude=tried)
+            if endpoint is None:
+                raise error
+            try:
+                return self._chat_hedged(endpoint, request)
+            except Exception as e:
+                logging.error(f"Request to {endpoint.backend.host} failed: {e}")
+                tried.append(endpoint)
+                error = e
+
+    def load(self, model):
+        """
+        Function to load a model on every endpoint that can be told to.
+        Returns the response of the slowest load.
+        """
+        responses = [
+            endpoint.backend.load(model)
+            for endpoint in self.endpoints
+            if hasattr(endpoint.backend, 'load')
+        ]
+        return max(responses, key=lambda response: response.get('load_duration') or 0, default={})
+
+    def health(self):
+        """
+        Function to check that at least one endpoint is up.
+        """
+        return any(endpoint.backend.health() for endpoint in self.endpoints)
+
+
+class ModelDeferred(Exception):
+    """
+    Raised by ModelScheduler for a request to the model that is not being
+    asked in the current pass. The job that made it is run again in the next pass.
+    """
+
+
+class ModelScheduler:
+    """
+    Backend wrapper grouping the requests of a small-to-large cascade by
+    model, so that each model is loaded once per pass instead of once per
+    escalation. The jobs of a stage are run in passes by iter_jobs, each
+    asking one model only: the small model first, then the large model for
+    the jobs that needed it, and so on while any job needs the other model.
+    A request for the other model raises ModelDeferred, which defers the
+    whole job to the next pass. Every answer is kept, so when a deferred job
+    is run again its earlier calls are replayed instead of being asked
+    again. Each model is loaded explicitly before its pass and nothing is
+    released, so the server only unloads a model if both do not fit in
+    memory. Loads are recorded separately from the chat calls.
+    """
+
+    def __init__(self, backend, small_model, large_model):
+        self.backend = backend
+        self.host = backend.host
+        self.small_model = small_model
+        self.large_model = large_model
+        self.model = None
+        self._answers = {}
+        self._lock = threading.Lock()
+
+    def load(self, model):
+        """
+        Function to load a model before its pass is sent.
+        """
+        start = time.perf_counter()
+        try:
+            response = self.backend.load(model)
+            telemetry.record(model=model, event='load', wall_time=time.perf_counter() - start, load_duration=response.get('load_duration'))
+        except Exception as e:
+            # The chat requests will load the model themselves
+            logging.error(f"Failed to load {model}: {e}")
+
+    def start_pass(self, model):
+        """
+        Function to start a pass in which only model is asked.
+        """
+        self.model = model
+        self.load(model)
+
+    def finish(self):
+        """
+        Function to stop deferring requests once every job is done, and
+        forget the answers kept for replaying.
+        """
+        self.model = None
+        with self._lock:
+            self._answers.clear()
+
+    def chat(self, model, messages, options=None, format=None):
+        """
+        Function to send a chat request, replay its earlier answer, or defer
+        it to the next pass if it is for the other model.
+        """
+        key = json.dumps([model, messages, options, format], sort_keys=True)
+        with self._lock:
+            message = self._answers.get(key)
+        if message is not None:
+            # Answered in an earlier pass, before the job was deferred
+            return {'message': message, 'replayed': True}
+        if self.model is not None and model != self.model:
+            raise ModelDeferred(f"{model} is asked in the next pass")
+        response = self.backend.chat(model, messages, options=options, format=format)
+        if self.model is not None:
+            with self._lock:
+                self._answers[key] = response['message']
+        return response
+
+    def health(self):
+        """
+        Function to check that the wrapped backend is up.
+        """
+        return self.backend.health()
+
+
+def add_backend_args(parser):
+    """
+    Function to add the command line arguments that select the inference backend.
+    Defaults can also be set with the LLM_BACKEND, LLM_HOST, LLM_TIMEOUT,
+    LLM_API_KEY, LLM_MODEL_PATH and LLM_KEEP_ALIVE environment variables.
+    """
+    parser.add_argument('--backend', choices=BACKENDS, default=os.environ.get('LLM_BACKEND', 'ollama'), help="Inference backend: ollama, openai (any OpenAI-compatible server) or llamacpp (in-process) (default: 'ollama')")
+    parser.add_argument('--host', default=os.environ.get('LLM_HOST'), help="URL of the inference server, or a comma-separated list of URLs to spread requests over several servers (default: http://127.0.0.1:18199 for ollama, http://127.0.0.1:8080 for openai)")
+    parser.add_argument('--timeout', default=os.environ.get('LLM_TIMEOUT', '600'), help="Timeout in seconds for a single request, or a comma-separated list with one timeout per host (default: 600)")
+    parser.add_argument('--hedge', action='store_true', help="If set with several hosts, a request slower than the p95 latency is also sent to a second host and the first answer is used.")
+    parser.add_argument('--api_key', default=os.environ.get('LLM_API_KEY'), help="API key for the openai backend, if the server needs one")
+    parser.add_argument('--model_path', default=os.environ.get('LLM_MODEL_PATH'), help="Path to the GGUF model file for the llamacpp backend")
+    parser.add_argument('--keep_alive', default=os.environ.get('LLM_KEEP_ALIVE', '30m'), help="How long the ollama server keeps a model loaded after its last request, e.g. '30m' or '-1' for ever (default: '30m')")
+    return parser
+
+
+def parse_keep_alive(keep_alive):
+    """
+    Function to convert a --keep_alive value to what Ollama expects: a
+    number of seconds, or a duration string such as '30m'.
+    """
+    try:
+        return int(keep_alive)
+    except ValueError:
+        return keep_alive
+
+
+def make_backend(args):
+    """
+    Function to create the inference backend selected on the command line.
+    """
+    if args.backend == 'llamacpp':
+        if not args.model_path:
+            raise ValueError("The llamacpp backend needs --model_path (or LLM_MODEL_PATH)")
+        return LlamaCppBackend(args.model_path)
+    hosts = (args.host or DEFAULT_HOSTS[args.backend]).split(',')
+    timeouts = [float(timeout) for timeout in str(args.timeout).split(',')]
+    if len(timeouts) == 1:
+        timeouts = timeouts * len(hosts)
+    if len(timeouts) != len(hosts):
+        raise ValueError("--timeout needs a single value or one value per host")
+    backends = []
+    for host, timeout in zip(hosts, timeouts):
+        if args.backend == 'openai':
+            backends.append(OpenAIBackend(host.strip(), timeout=timeout, api_key=args.api_key))
+        else:
+            backends.append(OllamaBackend(host.strip(), timeout=timeout, keep_alive=parse_keep_alive(args.keep_alive)))
+    backend = backends[0] if len(backends) == 1 else LoadBalancedBackend(backends, hedge=args.hedge)
+    if args.schedule_models and args.backend == 'ollama' and args.small_model and args.small_model != args.model_name:
+        # Ask the small model for every job first, then the large model for the escalations
+        backend = ModelScheduler(backend, args.small_model, args.model_name)
+    return backend
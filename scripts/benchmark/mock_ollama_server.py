@@ -0,0 +1,210 @@
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_SENTENCE = "Stems clustered, climbing, 3.0(2.0-4.0) m long."
+INVALID_OUTPUT = "Sure! Here is the JSON you asked for: {stemlength: 3.0 m"
+
+
+class MockConfig:
+    """
+    Settings of the mock server and counters of the requests it has served.
+    """
+
+    def __init__(self, latency=0.0, prompt_rate=None, eval_rate=None, invalid_rate=0.0, seed=0):
+        self.latency = latency
+        self.prompt_rate = prompt_rate
+        self.eval_rate = eval_rate
+        self.invalid_rate = invalid_rate
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def count_request(self, prompt_tokens):
+        """
+        Function to count a served request. Returns True if the answer should be invalid.
+        """
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            return self._random.random() < self.invalid_rate
+
+    def count_output(self, output_tokens):
+        """
+        Function to count the tokens of an answer.
+        """
+        with self._lock:
+            self.output_tokens += output_tokens
+
+    def reset(self):
+        """
+        Function to reset the request counters.
+        """
+        with self._lock:
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.output_tokens = 0
+
+
+def make_answer(request_format, invalid):
+    """
+    Function to build the canned answer for a request. Requests with a JSON
+    schema get a JSON object with a value for every required key; other
+    requests get a canned sentence.
+    """
+    if invalid:
+        return INVALID_OUTPUT
+    if isinstance(request_format, dict):
+        return json.dumps({key: "1" for key in request_format.get("required", [])})
+    if request_format == 'json':
+        return "{}"
+    return CANNED_SENTENCE
+
+
+def simulate(config, messages, request_format):
+    """
+    Function to work out the answer, token counts and durations of a request
+    and sleep for the simulated inference time.
+    """
+    prompt_tokens = max(1, sum(len(message.get("content", "")) for message in messages) // 4)
+    invalid = config.count_request(prompt_tokens)
+    content = make_answer(request_format, invalid)
+    output_tokens = max(1, len(content) // 4)
+    config.count_output(output_tokens)
+    prompt_seconds = prompt_tokens / config.prompt_rate if config.prompt_rate else 0.0
+    eval_seconds = output_tokens / config.eval_rate if config.eval_rate else 0.0
+    total_seconds = config.latency + prompt_seconds + eval_seconds
+    if total_seconds > 0:
+        time.sleep(total_seconds)
+    return content, prompt_tokens, output_tokens, prompt_seconds, eval_seconds, total_seconds
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """
+    Request handler speaking the parts of the Ollama API used by the
+    pipeline (/api/chat, /api/generate, /api/tags, /api/version), plus the OpenAI-compatible
+    /v1/chat/completions and /v1/models endpoints.
+    """
+
+    config = None
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output readable
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self.send_json({"models": []})
+        elif self.path == "/api/version":
+            self.send_json({"version": "mock"})
+        elif self.path == "/v1/models":
+            self.send_json({"object": "list", "data": []})
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        request = self.read_json()
+        if self.path == "/api/chat":
+            content, prompt_tokens, output_tokens, prompt_seconds, eval_seconds, total_seconds = simulate(
+                self.config, request.get("messages", []), request.get("format")
+            )
+            self.send_json({
+                "model": request.get("model", "mock"),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "message": {"role": "assistant", "content": content},
+                "done": True,
+                "done_reason": "stop",
+                "total_duration": int(total_seconds * 1e9),
+                "load_duration": 0,
+                "prompt_eval_count": prompt_tokens,
+                "prompt_eval_duration": int(prompt_seconds * 1e9),
+                "eval_count": output_tokens,
+                "eval_duration": int(eval_seconds * 1e9),
+            })
+        elif self.path == "/api/generate":
+            # Only used to load models, which the mock does instantly
+            self.send_json({
+                "model": request.get("model", "mock"),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "response": "",
+                "done": True,
+                "done_reason": "load" if request.get("keep_alive") != 0 else "unload",
+                "load_duration": 0,
+            })
+        elif self.path == "/v1/chat/completions":
+            response_format = request.get("response_format") or {}
+            request_format = response_format.get("json_schema", {}).get("schema")
+            content, prompt_tokens, output_tokens, *_ = simulate(
+                self.config, request.get("messages", []), request_format
+            )
+            self.send_json({
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens},
+            })
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+
+def start_server(port=0, config=None):
+    """
+    Function to start the mock server on a background thread.
+    Returns the server; server.server_address[1] is the port in use.
+    """
+    handler = type('ConfiguredMockOllamaHandler', (MockOllamaHandler,), {'config': config or MockConfig()})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def parse_args():
+    """
+    Function to parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Runs a fake Ollama server with canned answers for offline benchmarking.")
+    parser.add_argument('--port', type=int, default=18199, help="Port to listen on (default: 18199)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Fixed latency added to every request in seconds (default: 0)")
+    parser.add_argument('--prompt_rate', type=float, default=None, help="Simulated prompt ingestion speed in tokens/s (default: instant)")
+    parser.add_argument('--eval_rate', type=float, default=None, help="Simulated generation speed in tokens/s (default: instant)")
+    parser.add_argument('--invalid_rate', type=float, default=0.0, help="Fraction of answers that are invalid JSON (default: 0)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the invalid answers (default: 0)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = MockConfig(args.latency, args.prompt_rate, args.eval_rate, args.invalid_rate, args.seed)
+    server = start_server(args.port, config)
+    print(f"Mock Ollama server listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import csv
+import os
+import random
+import subprocess
+import sys
+import time
+from scripts import telemetry
+from scripts.benchmark.mock_ollama_server import MockConfig, start_server
+
+# The checkout the stage modules are imported from
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The five LLM stages, in pipeline order. Each entry gives the module and a
+# function returning its positional arguments for the benchmark directory.
+STAGES = {
+    'app1_extraction': (
+        'scripts.trait_extraction.app1_extraction',
+        lambda d: [d['sentences'], d['appendix_1'], os.path.join(d['dir'], 'quantitative_traits.csv')],
+    ),
+    'app2_extraction': (
+        'scripts.trait_extraction.app2_extraction',
+        lambda d: [d['sentences'], d['appendix_2'], 'fewshot', os.path.join(d['dir'], 'qualitative_traits.csv')],
+    ),
+    'app1_descriptions': (
+        'scripts.description_generation.app1_descriptions',
+        # --llm, as the default template mode makes no calls
+        lambda d: [d['appendix_1'], d['supp_data'], os.path.join(d['dir'], 'app1_descriptions.csv'), '--llm'],
+    ),
+    'app2_descriptions': (
+        'scripts.description_generation.app2_descriptions',
+        lambda d: [d['appendix_2'], d['supp_data'], d['supp_data_multi'], os.path.join(d['dir'], 'app2_descriptions.csv'), '--states_file', d['appendix_2_states']],
+    ),
+    'combine_descriptions': (
+        'scripts.description_generation.combine_descriptions',
+        lambda d: [os.path.join(d['dir'], 'app1_descriptions.csv'), os.path.join(d['dir'], 'app2_descriptions.csv'), os.path.join(d['dir'], 'final_combined_descriptions.csv')],
+    ),
+}
+
+
+def parse_args():
+    """
+    Function to parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks the LLM pipeline stages against a mock Ollama server with synthetic inputs.")
+    parser.add_argument('output_dir', help="Directory for the synthetic inputs, stage outputs and metrics")
+    parser.add_argument('--appendix_1', default=os.path.join(REPO_DIR, 'resources', 'appendix_1.txt'), help="Path to the raw appendix 1 text file (default: resources/appendix_1.txt)")
+    parser.add_argument('--appendix_2', default=os.path.join(REPO_DIR, 'resources', 'appendix_2.txt'), help="Path to the raw appendix 2 text file (default: resources/appendix_2.txt)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 100, 1000], help="Numbers of synthetic taxa to benchmark (default: 5 100 1000)")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES), help="Stages to run (default: all)")
+    parser.add_argument('--concurrency', type=int, default=1, help="Number of LLM requests each stage keeps in flight (default: 1)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Fixed latency of the mock server per request in seconds (default: 0)")
+    parser.add_argument('--prompt_rate', type=float, default=None, help="Simulated prompt ingestion speed in tokens/s (default: instant)")
+    parser.add_argument('--eval_rate', type=float, default=None, help="Simulated generation speed in tokens/s (default: instant)")
+    parser.add_argument('--invalid_rate', type=float, default=0.0, help="Fraction of mock answers that are invalid JSON (default: 0)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the synthetic data and invalid answers (default: 0)")
+    parser.add_argument('--results_file', default=None, help="Optional path to a CSV file where the benchmark results are saved")
+    return parser.parse_args()
+
+
+def clean_appendices(args):
+    """
+    Function to turn the raw appendix text files into the CSV files the
+    pipeline reads, using the same script as the Makefile.
+    """
+    paths = {
+        'appendix_1': os.path.join(args.output_dir, 'appendix_1.csv'),
+        'appendix_2': os.path.join(args.output_dir, 'appendix_2.csv'),
+        'appendix_2_states': os.path.join(args.output_dir, 'appendix_2_states.csv'),
+    }
+    script = os.path.join(REPO_DIR, 'scripts', 'monograph_text_extraction', 'clean_appendix.py')
+    subprocess.run([sys.executable, script, args.appendix_1, '--quantitative', paths['appendix_1']], check=True)
+    subprocess.run([sys.executable, script, args.appendix_2, paths['appendix_2'], '--states_file', paths['appendix_2_states']], check=True)
+    return paths
+
+
+def read_rows(path):
+    """
+    Function to read a CSV file into a list of dicts.
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as file_in:
+        return list(csv.DictReader(file_in))
+
+
+def write_rows(path, fieldnames, rows):
+    """
+    Function to write a list of dicts to a CSV file.
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as file_out:
+        writer = csv.DictWriter(file_out, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def make_inputs(size_dir, num_taxa, app1_rows, app2_rows, rng):
+    """
+    Function to write synthetic sentences and supplementary data for
+    num_taxa taxa, shaped like the outputs of extract_treatments.py and
+    format_supplementary_data.py.
+    """
+    taxa = [f"Calamus syntheticus{i:04d}" for i in range(num_taxa)]
+    app1_codes = [row['code'] for row in app1_rows]
+    # The last entry of appendix 2 (frucol) is free text, the others are coded states
+    app2_codes = [row['code'] for row in app2_rows[:-1]]
+    # One sentence per subject and taxon, half of them with measurements
+    subjects = sorted({row['subject_extract'] for row in app1_rows + app2_rows if row.get('subject_extract')})
+    sentence_rows = []
+    for taxon_name in taxa:
+        for subject in subjects:
+            sentence = f"{subject} slender, glabrous"
+            if rng.random() < 0.5:
+                sentence += f", {rng.randint(2, 40)}-{rng.randint(41, 90)} cm long, {rng.randint(1, 9)} mm wide"
+            sentence_rows.append({
+                'taxon_name': taxon_name,
+                'sentence': sentence + ".",
+                'subject_gen': subject,
+                'subject_extract': subject,
+            })
+    # One row per taxon with "mean(min-max)" measurements and coded states
+    supp_rows = []
+    multi_rows = []
+    for taxon_name in taxa:
+        supp_row = {'taxon_name': taxon_name}
+        for code in app1_codes:
+            low, high = sorted(rng.uniform(1, 100) for _ in range(2))
+            supp_row[code] = f"{(low + high) / 2:.1f}({low:.1f}-{high:.1f})" if rng.random() < 0.8 else ''
+        for code in app2_codes:
+            value = rng.randint(0, 2)
+            supp_row[code] = f"{value}.0" if rng.random() < 0.8 else ''
+            # A few codes were scored with more than one state
+            if supp_row[code] and rng.random() < 0.1:
+                supp_row[code] = f"{value}, {(value + 1) % 3}"
+                num_specimens = rng.randint(2, 30)
+                multi_rows.append({
+                    'taxon_name': taxon_name,
+                    'code': code,
+                    'value': value,
+                    'frequency': rng.randint(1, num_specimens),
+                    'num_specimens': num_specimens,
+                    'num_specimens_scored': num_specimens,
+                    'other_values': (value + 1) % 3,
+                })
+        supp_row['frucol'] = "Fruit scales yellowish-brown." if rng.random() < 0.5 else ''
+        supp_rows.append(supp_row)
+    paths = {
+        'dir': size_dir,
+        'sentences': os.path.join(size_dir, 'sentences.csv'),
+        'supp_data': os.path.join(size_dir, 'formatted_supp_data.csv'),
+        'supp_data_multi': os.path.join(size_dir, 'supp_data_multi.csv'),
+    }
+    write_rows(paths['sentences'], ['taxon_name', 'sentence', 'subject_gen', 'subject_extract'], sentence_rows)
+    write_rows(paths['supp_data'], ['taxon_name'] + app1_codes + app2_codes + ['frucol'], supp_rows)
+    write_rows(paths['supp_data_multi'], ['taxon_name', 'code', 'value', 'frequency', 'num_specimens', 'num_specimens_scored', 'other_values'], multi_rows)
+    return paths
+
+
+def run_stage(stage, paths, server, config, args):
+    """
+    Function to run one pipeline stage against the mock server and return
+    its timings.
+    """
+    module, stage_args = STAGES[stage]
+    metrics_file = os.path.join(paths['dir'], f"{stage}.metrics.jsonl")
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+    command = [
+        sys.executable, '-m', module, *stage_args(paths),
+        '--backend', 'ollama',
+        '--host', f"http://127.0.0.1:{server.server_address[1]}",
+        '--no_cache',
+        '--concurrency', str(args.concurrency),
+        '--checkpoint_file', os.path.join(paths['dir'], f"{stage}.checkpoint.jsonl"),
+        '--fresh',
+        '--metrics_file', metrics_file,
+    ]
+    # Run the stage in the benchmark directory, so its log file is written
+    # there rather than into the checkout
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')]))}
+    config.reset()
+    start = time.perf_counter()
+    completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, cwd=paths['dir'], env=env)
+    wall_seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        print(completed.stderr, file=sys.stderr)
+    # Time the server spent "running the model", as reported in the responses
+    records = telemetry.read_metrics([metrics_file]) if os.path.exists(metrics_file) else []
+    model_seconds = sum(r.get('total_duration') or 0 for r in records) / 1e9
+    calls = config.requests
+    return {
+        'stage': stage,
+        'status': 'ok' if completed.returncode == 0 else f"failed ({completed.returncode})",
+        'calls': calls,
+        'prompt_tokens': config.prompt_tokens,
+        'wall_seconds': wall_seconds,
+        'model_seconds': model_seconds,
+        # Everything that is not simulated inference: start-up, pandas, prompt building, HTTP
+        'overhead_ms_per_call': 1000 * (wall_seconds - model_seconds / args.concurrency) / calls if calls else None,
+    }
+
+
+def print_results(results):
+    """
+    Function to print the benchmark results as a table.
+    """
+    header = f"{'taxa':>6}  {'stage':<22}{'status':<12}{'calls':>8}{'prompt tok':>12}{'wall s':>10}{'ms/call':>10}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        overhead = result['overhead_ms_per_call']
+        overhead = 'n/a' if overhead is None else f"{overhead:.1f}"
+        print(f"{result['taxa']:>6}  {result['stage']:<22}{result['status']:<12}{result['calls']:>8}{result['prompt_tokens']:>12}{result['wall_seconds']:>10.1f}{overhead:>10}")
+
+
+def main():
+    # Parse arguments
+    args = parse_args()
+    # The stages run in the output directory, so every path they get is absolute
+    args.output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+    rng = random.Random(args.seed)
+    # Build the appendix CSV files once, from the real appendices
+    appendix_paths = clean_appendices(args)
+    app1_rows = read_rows(appendix_paths['appendix_1'])
+    app2_rows = read_rows(appendix_paths['appendix_2'])
+    # Start the mock server on a free port
+    config = MockConfig(args.latency, args.prompt_rate, args.eval_rate, args.invalid_rate, args.seed)
+    server = start_server(0, config)
+    results = []
+    try:
+        for size in args.sizes:
+            size_dir = os.path.join(args.output_dir, f"taxa_{size}")
+            os.makedirs(size_dir, exist_ok=True)
+            paths = {**make_inputs(size_dir, size, app1_rows, app2_rows, rng), **appendix_paths}
+            for stage in args.stages:
+                print(f"Running {stage} with {size} taxa")
+                results.append({'taxa': size, **run_stage(stage, paths, server, config, args)})
+    finally:
+        server.shutdown()
+    print_results(results)
+    if args.results_file:
+        write_rows(args.results_file, list(results[0]), results)
+
+if __name__ == "__main__":
+    main()
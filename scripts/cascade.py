@@ -0,0 +1,119 @@
+import threading
+from scripts import telemetry
+from scripts.backends import ModelScheduler
+from scripts.utils import extract_batch, parse_json_output
+
+
+def open_cascade(args, llm_client=None):
+    """
+    Function to set up the small-to-large model cascade, if --small_model is set.
+    If llm_client is a ModelScheduler, the jobs are run in passes by model.
+    """
+    if not args.small_model:
+        return None
+    hard_codes = [code.strip() for code in args.hard_codes.split(',') if code.strip()]
+    scheduler = llm_client if isinstance(llm_client, ModelScheduler) else None
+    return Cascade(args.small_model, args.model_name, hard_codes, scheduler)
+
+
+class Cascade:
+    """
+    Small-to-large model cascade. Each call is first answered by the small
+    model and is only repeated on the large model when the answer fails a
+    check (invalid JSON, a value that fails validation or a deterministic
+    check on generated text). Codes in hard_codes always go to the large
+    model. The outcomes are kept per unit of work, shared between worker
+    threads, so those of a job deferred by the scheduler can be forgotten.
+    """
+
+    def __init__(self, small_model, large_model, hard_codes=(), scheduler=None):
+        self.small_model = small_model
+        self.large_model = large_model
+        self.hard_codes = set(hard_codes)
+        self.scheduler = scheduler
+        self.outcomes = {}
+        self._lock = threading.Lock()
+
+    def record(self, code, outcome):
+        """
+        Function to record the outcome ('small', 'escalated' or 'hard') of a
+        code against the current unit of work.
+        """
+        with self._lock:
+            self.outcomes.setdefault(telemetry.current('unit'), []).append((code, outcome))
+
+    def forget(self, unit):
+        """
+        Function to forget the outcomes of a unit of work that is run again.
+        """
+        with self._lock:
+            self.outcomes.pop(unit, None)
+
+    def ask(self, ask, check, code, hard=False):
+        """
+        Function to get an answer for one code. ask(model_name) makes the call
+        and check(output) returns False when the answer must be escalated.
+        hard sends the call straight to the large model, e.g. when a call
+        covering several codes includes a hard one.
+        """
+        if hard or code in self.hard_codes:
+            self.record(code, 'hard')
+            return ask(self.large_model)
+        with telemetry.call_context(tier='small'):
+            output = ask(self.small_model)
+        if check(output):
+            self.record(code, 'small')
+            return output
+        self.record(code, 'escalated')
+        with telemetry.call_context(tier='large'):
+            return ask(self.large_model)
+
+    def extract(self, ask, batch, validate=None, stats=None):
+        """
+        Function to extract the values for a batch of appendix items.
+        ask(batch, model_name) sends the prompt for the batch. The small
+        model is asked once for the batch. Codes it leaves missing or invalid,
+        and hard codes, are then extracted by the large model with the usual
+        repairs of extract_batch.
+        """
+        codes = [item['code'] for item in batch]
+        easy = [item for item in batch if item['code'] not in self.hard_codes]
+        result = {}
+        if easy:
+            with telemetry.call_context(codes=[item['code'] for item in easy], repair=False, tier='small'):
+                output = ask(easy, self.small_model)
+            parsed = parse_json_output(output)
+            for item in easy:
+                code = item['code']
+                if parsed is not None and code in parsed and (validate is None or validate(parsed[code])):
+                    result[code] = parsed[code]
+                    self.record(code, 'small')
+                else:
+                    self.record(code, 'escalated')
+            if stats is not None:
+                stats.record_call(False, len(easy), parsed is not None, len(easy) - len(result))
+        for code in self.hard_codes.intersection(codes):
+            self.record(code, 'hard')
+        large = [item for item in batch if item['code'] not in result]
+        if large:
+            with telemetry.call_context(tier='large'):
+                result.update(extract_batch(lambda items: ask(items, self.large_model), large, validate, stats))
+        # Keep the codes in appendix order
+        return {code: result[code] for code in codes if code in result}
+
+    def report(self):
+        """
+        Function to print how often each code was escalated to the large model.
+        """
+        counts = {}
+        with self._lock:
+            for outcomes in self.outcomes.values():
+                for code, outcome in outcomes:
+                    counts.setdefault(code, {'small': 0, 'escalated': 0, 'hard': 0})[outcome] += 1
+        total_small = sum(c['small'] + c['escalated'] for c in counts.values())
+        total_escalated = sum(c['escalated'] for c in counts.values())
+        print(f"Cascade {self.small_model} -> {self.large_model}: {total_escalated} of {total_small} small-model answers escalated ({total_escalated / max(total_small, 1):.1%})")
+        for code, c in counts.items():
+            answered = c['small'] + c['escalated']
+            rate = f"{c['escalated'] / answered:.1%}" if answered else 'n/a'
+            print(f"  {code}: {c['escalated']} of {answered} escalated ({rate}), {c['hard']} sent straight to the large model")
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+
+class Checkpoint:
+    """
+    Append-only JSON lines file recording the result of each completed unit
+    of work (e.g. a taxon and subject pair). Results are written as soon as
+    a unit finishes, so a run that crashes or is killed can be restarted with
+    resume=True and only the missing units are repeated. An existing
+    checkpoint is only overwritten with fresh=True. Only the results
+    loaded on resume are kept in memory, units completed during the run are
+    only written to the file, so memory does not grow with the results.
+    """
+
+    def __init__(self, path, resume=False, fresh=False):
+        self.path = path
+        # Do not overwrite the progress of an interrupted run by accident
+        if not resume and not fresh and os.path.exists(path) and os.path.getsize(path) > 0:
+            raise FileExistsError(f"{path} holds the progress of an earlier run. Use --resume to continue it or --fresh to start over.")
+        self.results = {}
+        # Units finish on different worker threads, so guard the file with a lock
+        self._lock = threading.Lock()
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file_in:
+                for line in file_in:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may have been cut short when the run was killed
+                        continue
+                    self.results[self._key(record['unit'])] = record['result']
+            self._file = open(path, 'a', encoding='utf-8')
+            # Start on a fresh line if the last record was cut short
+            if os.path.getsize(path) > 0:
+                with open(path, 'rb') as file_in:
+                    file_in.seek(-1, os.SEEK_END)
+                    if file_in.read(1) != b'\n':
+                        self._file.write('\n')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+
+    @staticmethod
+    def _key(unit):
+        """
+        Function to turn a unit of work into a hashable key.
+        """
+        if isinstance(unit, (list, tuple)):
+            unit = list(unit)
+        return json.dumps(unit, ensure_ascii=False)
+
+    def done(self, unit):
+        """
+        Function to check whether a unit of work was completed before the
+        run was resumed.
+        """
+        return self._key(unit) in self.results
+
+    def get(self, unit):
+        """
+        Function to return the stored result of a unit of work completed
+        before the run was resumed.
+        """
+        return self.results[self._key(unit)]
+
+    def append(self, unit, result):
+        """
+        Function to record the result of a completed unit of work.
+        """
+        record = json.dumps({"unit": unit, "result": result}, ensure_ascii=False)
+        with self._lock:
+            self._file.write(record + '\n')
+            self._file.flush()
+
+    def close(self):
+        """
+        Function to close the checkpoint file, keeping it for --resume.
+        """
+        with self._lock:
+            self._file.close()
+
+    def remove(self):
+        """
+        Function to close and delete the checkpoint once the output is saved.
+        """
+        self.close()
+        os.remove(self.path)
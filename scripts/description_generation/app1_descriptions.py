@@ -1,16 +1,37 @@
 import argparse
+from contextlib import nullcontext
 import numpy as np
-import ollama
 import pandas as pd
 import re
 import textwrap
-from scripts.utils import get_supp_codes, llm_chat, append_output
+from scripts.session import open_session
+from scripts.utils import add_llm_args, SuppDataIndex, to_records_json, llm_chat, append_output, run_jobs, report_plan, read_table
 
 # Ensure that entire descriptions can be printed and used
 pd.set_option('display.max_colwidth', None)
 
 SYSTEM_MESSAGE = "You are an expert botanist."
 
+# Bump to invalidate cached responses for this prompt template
+PROMPT_VERSION = "app1_descriptions-v2"
+
+# The instructions and example, followed in each prompt by the trait and value
+PROMPT_PREFIX = textwrap.dedent("""
+    ### Instructions ###
+    Use the "description" and "unit" of the trait and the 
+    corresponding "value" to create a simple sentence 
+    describing that particular trait. Your output should be one 
+    sentence. Blank values should return an empty string. Include no 
+    extra text.
+
+    ### Example ###
+    Using {"code":"rachislen","description":"Rachis length","unit":"cm"} 
+    and {"code":"rachislen","value":"41.0(25.5-70.0)"}, the output 
+    would be 'Rachis length is 41.0(25.5-70.0)cm'.
+
+    ### Materials ###
+""")
+
 
 def parse_args():
     """
@@ -21,6 +42,8 @@ def parse_args():
     parser.add_argument('input_file_supp_data', help="Path to the input CSV file containing the supplementary data")
     parser.add_argument('output_file', help="Path to the output CSV file where the descriptions are saved")
     parser.add_argument('--model_name', default='llama3.3', help="Name of the model to use for the chat completion (default: 'llama3.3')")
+    parser.add_argument('--llm', action='store_true', help="If set, the sentences are written by the LLM for more varied wording instead of from a template.")
+    add_llm_args(parser)
     return parser.parse_args()
 
 
@@ -38,7 +61,7 @@ def process_appendix1(file_path):
 def process_supp_data(file_path):
     # Read in the formatted supplementary data
     supp_data = (
-        pd.read_csv(file_path)
+        read_table(file_path)
         .replace(to_replace=np.nan, value='')
         .iloc[:, 0:15]
     )
@@ -62,56 +85,128 @@ def process_output(output):
     return output
 
 
+def render_sentence(description, unit, value):
+    """
+    Function to write the sentence for one Appendix I trait from a template,
+    e.g. 'Rachis length is 41.0(25.5-70.0) cm.' Blank values give an empty string.
+    """
+    value = str(value).strip()
+    if not re.search(r'\d', value):
+        return ''
+    sentence = f"{description} is {value}"
+    if unit:
+        sentence += f" {unit}"
+    # Clean the output the same way as the LLM output
+    return process_output(sentence + ".")
+
+
+def index_traits(df_app1):
+    """
+    Function to get the code, description and unit of every Appendix I code
+    as a JSON string, keyed by code.
+    """
+    traits = {}
+    for row in df_app1[["code", "description", "unit"]].to_dict(orient='records'):
+        traits.setdefault(row['code'], []).append(row)
+    return {code: to_records_json(rows) for code, rows in traits.items()}
+
+
+def build_prompt(traits, supp_index, taxon_name, code):
+    """
+    Function to build the LLM prompt for one Appendix I code of one taxon.
+    traits is the output of index_traits and supp_index a SuppDataIndex.
+    Returns None when the value is blank, as there is nothing to describe.
+    """
+    if not re.search(r'\d', str(supp_index.value(taxon_name, code))):
+        return None
+    # The code and value, and the trait of the code, as JSON
+    supp_codes = supp_index.supp_codes(taxon_name, code)
+    app1_descriptions = traits.get(code, to_records_json([]))
+    # Set up the prompt, the variable material goes after the fixed prefix
+    return PROMPT_PREFIX + f"Trait: {app1_descriptions}\nValue: {supp_codes}\n"
+
+
+def describe_code(llm_client, cache, model_name, traits, supp_index, taxon_name, code, cascade=None):
+    """
+    Function to generate the sentence for one Appendix I code of one taxon.
+    With a cascade, the small model's sentence is kept unless cleaning it
+    leaves nothing.
+    """
+    prompt = build_prompt(traits, supp_index, taxon_name, code)
+    if prompt is None:
+        return ''
+    # Send the prompt to the LLM
+    ask = lambda model_name: llm_chat(llm_client, model_name, SYSTEM_MESSAGE, prompt, cache=cache, prompt_version=PROMPT_VERSION)
+    if cascade is not None:
+        output = cascade.ask(ask, lambda output: process_output(output).strip() != '', code)
+    else:
+        output = ask(model_name)
+    # Clean the output
+    return process_output(output)
+
+
 def main():
     # Parse arguments
     args = parse_args()
-    # Set up connection to ollama model on HPC
-    ollama_client = ollama.Client(host='http://127.0.0.1:18199')
     # Read in the input files
     df_app1 = process_appendix1(args.input_file_app1)
     supp_data, tidy_supp_data = process_supp_data(args.input_file_supp_data)
-    # Create an empty list to store the output
-    output_list = []
-    # Iterate over each taxon_name
-    for taxon_name in supp_data.taxon_name.unique():
-        # Iterate over each code in the app1 DataFrame
-        for code in df_app1.code.unique():
-            # Look up subject that relates to code
-            subject = df_app1.loc[df_app1["code"] == code, "subject"].iloc[0]
-            # Filter the supplementary data for the specific code and taxon_name 
-            # And convert to json
-            supp_codes = get_supp_codes(tidy_supp_data, code, taxon_name)
-            # Filter the app1 DataFrame for the specific code
-            # And convert to json
-            app1_descriptions = df_app1[
-                df_app1.code == code
-            ][["code", "description", "unit"]].to_json(orient='records')
-            # Set up the prompt
-            prompt = textwrap.dedent(f"""
-                ### Instructions ###
-                Use the "description" and "unit" in {app1_descriptions} and the 
-                corresponding "value" in {supp_codes} to create a simple sentence 
-                describing that particular trait. Your output should be one 
-                sentence. Blank values should return an empty string. Include no 
-                extra text.
-
-                ### Example ###
-                Using {{"code":"rachislen","description":"Rachis length","unit":"cm"}} 
-                and {{"code":"rachislen","value":"41.0(25.5-70.0)"}}, the output 
-                would be 'Rachis length is 41.0(25.5-70.0)cm'.
-            """)
-            # Send the prompt to the LLM
-            output = llm_chat(ollama_client, args.model_name, SYSTEM_MESSAGE, prompt)
-            # Clean the output
-            output = process_output(output)
+    # Index the values and traits once, so each unit is a dictionary lookup
+    supp_index = SuppDataIndex(tidy_supp_data)
+    traits = index_traits(df_app1)
+    # Each taxon and code pair is an independent unit of work
+    units = [
+        (taxon_name, code)
+        for taxon_name in supp_data.taxon_name.unique()
+        for code in df_app1.code.unique()
+    ]
+    if args.plan:
+        # Only the LLM mode makes calls, and only for the codes with a value
+        prompts = []
+        if args.llm:
+            prompts = [build_prompt(traits, supp_index, *unit) for unit in units]
+            prompts = [prompt for prompt in prompts if prompt is not None]
+        report_plan(args, 'app1_descriptions', SYSTEM_MESSAGE, prompts, len(units) - len(prompts))
+        return
+    # Set up the model, cache, metrics, checkpoint and cascade for the LLM mode,
+    # closed even if the run fails
+    session = open_session(args, 'app1_descriptions') if args.llm else nullcontext((None, None, None, None))
+    with session as (llm_client, cache, checkpoint, cascade):
+        if args.llm:
+            # The units can be sent to the model concurrently
+            outputs = run_jobs(
+                lambda unit: describe_code(llm_client, cache, args.model_name, traits, supp_index, *unit, cascade=cascade),
+                units,
+                args.concurrency,
+                checkpoint,
+                cascade,
+            )
+        else:
+            # Look up the description and unit of every code
+            trait_rows = df_app1.drop_duplicates('code').set_index('code')
+            # Fill in the template for each unit
+            outputs = [
+                render_sentence(trait_rows.at[code, 'description'], trait_rows.at[code, 'unit'], supp_index.value(taxon_name, code))
+                for taxon_name, code in units
+            ]
+        # Look up the subject that relates to each code
+        first_rows = df_app1.drop_duplicates('code')
+        subjects = dict(zip(first_rows.code, first_rows.subject))
+        # Create an empty list to store the output
+        output_list = []
+        for (taxon_name, code), output in zip(units, outputs):
+            subject = subjects[code]
             # Store the output in a dictionary and append to output list
             append_output(output_list, taxon_name, output, subject)
-    # Create a DataFrame from the output list
-    df_output = pd.DataFrame(output_list)
-    # Remove any rows where the output_sentence is an empty string
-    df_output = df_output[df_output["output_sentence"].str.strip() != ""]
-    # Save the output to a CSV file
-    df_output.to_csv(args.output_file, index=False)
+        # Create a DataFrame from the output list
+        df_output = pd.DataFrame(output_list)
+        # Remove any rows where the output_sentence is an empty string
+        df_output = df_output[df_output["output_sentence"].str.strip() != ""]
+        # Save the output to a CSV file
+        df_output.to_csv(args.output_file, index=False)
+        if args.llm:
+            # The output is saved, so the checkpoint is no longer needed
+            checkpoint.remove()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
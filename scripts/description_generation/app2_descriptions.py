@@ -1,17 +1,86 @@
 import argparse
 import json
 import numpy as np
-import ollama
 import pandas as pd
 import re
 import textwrap
-from scripts.utils import get_supp_codes, llm_chat, append_output
+from scripts.session import open_session
+from scripts.utils import add_llm_args, SuppDataIndex, to_records_json, llm_chat, append_output, run_jobs, report_plan, read_table
 
 # Ensure that entire descriptions can be printed and used
 pd.set_option('display.max_colwidth', None)
 
 SYSTEM_MESSAGE = "You are an expert botanist. You have created a trait data matrix from herbarium specimens. You are writing species descriptions based on the data matrix."
 
+# Bump to invalidate cached responses for the prompt templates
+MULTI_VAL_PROMPT_VERSION = "app2_descriptions-multi-v2"
+SINGLE_VAL_PROMPT_VERSION = "app2_descriptions-single-v2"
+
+# The instructions and examples, followed in each prompt by the rules and value
+MULTI_VAL_PROMPT_PREFIX = textwrap.dedent("""
+    ### Instructions ###
+    Use the rules and the value provided to to produce a concise, 
+    natural-sounding sentence that reflects the dominant trait observed.
+
+    Each set of rules is a string of semicolon-separated options in the format: 
+    "Trait description (value)". Match the trait code in the 'value' to 
+    its description in the rules.
+
+    - 'frequency': Number of times the dominant trait was observed.
+    - 'num_specimens_scored': Total specimens observed.
+    - 'other_values': Other trait codes observed in remaining specimens.
+
+    Use the frequency and specimen count to adjust your wording:
+    - If the dominant trait was found in all or nearly all specimens, state it directly.
+    - If it was found in most but not all, use qualifiers like "usually", "sometimes".
+    - If found in a very small proportion of specimens, use "rarely".
+
+    **Output a single sentence only. No labels, no extra text.**
+
+    Use the following examples to guide your response:
+
+    ### Example 1 ###
+    Input:
+    - Rules: "Stems solitary (0); stems clustered (1)"
+    - Value: {"code": "solclu", "value": "1"}
+    - frequency: 3
+    - num_specimens_scored: 4
+    - other_values: [0]
+
+    Output: "Stems clustered, rarely solitary."
+
+    ### Example 2 ###
+    Input:
+    - Rules: "Proximalmost pinnae swept back across the sheath (on adult plants only) (0); 
+      proximalmost pinnae not swept back across the sheath (1)"
+    - Value: {"code": "sweptb", "value": 1.0}
+    - frequency: 19
+    - num_specimens_scored: 29
+    - other_values: [0]
+
+    Output: "Proximalmost pinnae sometimes swept back across the sheath."
+
+    ### Materials ###
+""")
+
+SINGLE_VAL_PROMPT_PREFIX = textwrap.dedent("""
+    ### Instructions ###
+    Using the "rules" and the corresponding "value" below, output 
+    the rule that matches the value.
+    Return only an output sentence, NO EXTRA TEXT.
+
+    ### Example ###
+    Using {"code":"rachil","rules":"Petioles and rachises with at
+    least some long, straight, flat, usually grouped spines
+    abaxially (0); petioles and rachises with whorls of long,
+    straight, flat spines (1); rachises without long, straight,
+    flat spines abaxially (2)"} and {"code":"rachil","value":"2"},
+    the output would be 'rachises without long, straight, flat
+    spines abaxially' only.
+
+    ### Materials ###
+""")
+
 
 def process_appendix2(file_path):
     """
@@ -39,7 +108,7 @@ def process_supp_data(file_path, file_path_multi):
     """
     # Read in the formatted supplementary data
     supp_data = (
-        pd.read_csv(file_path)
+        read_table(file_path)
         .replace(to_replace=np.nan, value='')
         .drop('frucol', axis=1)
     )
@@ -52,7 +121,7 @@ def process_supp_data(file_path, file_path_multi):
         .replace(r'\.0', '', regex=True)
     )
     # Read in the multi-value qualitative data
-    multi_qual = pd.read_csv(file_path_multi)
+    multi_qual = read_table(file_path_multi)
     return supp_data, tidy_supp_data, multi_qual
 
 
@@ -60,12 +129,50 @@ def process_frucol(file_path):
     """
     Function to read and process the frucol data.
     """
-    df_frucol = pd.read_csv(file_path)
+    df_frucol = read_table(file_path)
     df_frucol = df_frucol[['taxon_name', 'frucol']].rename(columns={'frucol': 'output_sentence'}).dropna()
     df_frucol['subject'] = 'Fruit'
     return df_frucol
 
 
+def read_states(file_path):
+    """
+    Function to read the table of states written by clean_appendix.py
+    into a dict of state text keyed by (code, value).
+    """
+    df_states = pd.read_csv(file_path, dtype={'state': str})
+    return dict(zip(zip(df_states.code, df_states.state), df_states.text))
+
+
+def render_state(text):
+    """
+    Function to turn the text of a state into a sentence without the LLM.
+    Like clean_output, a state that is only 'not as above' gives an empty
+    string, and so does a state without text.
+    """
+    text = '' if pd.isna(text) else str(text).strip()
+    if not text or re.search(r'not as above', text):
+        return ''
+    return text[0].upper() + text[1:] + '.'
+
+
+def rule_for_value(rules, code, value):
+    """
+    Function to get the option of a code's rules that a value refers to,
+    e.g. 'stems clustered (1)' for solclu and 1.0. rules is the output of
+    index_rules. Returns an empty string if no option matches.
+    """
+    try:
+        number = int(float(value))
+    except (TypeError, ValueError):
+        return ''
+    for row in json.loads(rules.get(code, '[]')):
+        for option in str(row['rules']).split(';'):
+            if re.search(rf"\({number}\)", option):
+                return option.strip()
+    return ''
+
+
 def clean_output(output):
     """
     Function to clean the output.
@@ -100,137 +207,185 @@ def parse_args():
     parser.add_argument('multi_input_file', help="Path to the input CSV file containing the multi-value qualitative data")
     parser.add_argument('output_file', help="Path to the output CSV file where the descriptions are saved")
     parser.add_argument('--model_name', default='llama3.3', help="Name of the model to use for the chat completion (default: 'llama3.3')")
+    parser.add_argument('--states_file', default=None, help="Path to the CSV file of appendix 2 states written by clean_appendix.py. If set, single values are rendered from the states and the LLM is only used for multi-value codes.")
+    add_llm_args(parser)
     return parser.parse_args()
 
 
+def index_rules(df_app2):
+    """
+    Function to get the rules of every code as a JSON string, keyed by code.
+    """
+    rules = {}
+    for row in df_app2[["code", "rules"]].to_dict(orient='records'):
+        rules.setdefault(row['code'], []).append(row)
+    return {code: to_records_json(rows) for code, rows in rules.items()}
+
+
+def build_multi_prompt(rules, supp_index, taxon_name, code):
+    """
+    Function to build the prompt for a code that was scored with several
+    values for one taxon. Returns None when the taxon has no multi-value
+    data for the code.
+    """
+    app2_rules = rules.get(code, to_records_json([]))
+    # Find the corresponding rows of the multi-value data for this taxon_name and code
+    multi_rows = supp_index.multi(taxon_name, code)
+    if not multi_rows:
+        return None
+    multi_supp_codes = [{"code": row['code'], "value": row['value']} for row in multi_rows]
+    other_values = to_records_json([row['other_values'] for row in multi_rows])
+    frequency = to_records_json([row['frequency'] for row in multi_rows])
+    num_specimens_scored = to_records_json([row['num_specimens_scored'] for row in multi_rows])
+    # The variable material goes after the fixed prefix
+    return MULTI_VAL_PROMPT_PREFIX + textwrap.dedent(f"""
+        - Rules: {app2_rules}
+        - Value: {multi_supp_codes}
+        - frequency: {frequency}
+        - num_specimens_scored: {num_specimens_scored}
+        - other_values: {other_values}
+    """).lstrip()
+
+
+def build_single_prompt(rules, code, value):
+    """
+    Function to build the prompt for a code scored with a single value.
+    """
+    app2_rules = rules.get(code, to_records_json([]))
+    supp_codes = [{"code": code, "value": value}]
+    # The variable material goes after the fixed prefix
+    return SINGLE_VAL_PROMPT_PREFIX + f"Rules: {app2_rules}\nValue: {supp_codes}\n"
+
+
+def build_prompt(rules, supp_index, unit):
+    """
+    Function to build the prompt for one planned unit of work, either
+    ('single', code, value) or ('multi', taxon_name, code). rules is the
+    output of index_rules and supp_index a SuppDataIndex.
+    Returns the prompt and its version, or None when there is nothing to describe.
+    """
+    kind, *key = unit
+    if kind == 'multi':
+        prompt = build_multi_prompt(rules, supp_index, *key)
+        return None if prompt is None else (prompt, MULTI_VAL_PROMPT_VERSION)
+    return build_single_prompt(rules, *key), SINGLE_VAL_PROMPT_VERSION
+
+
+def describe_unit(llm_client, cache, model_name, rules, supp_index, unit, cascade=None):
+    """
+    Function to generate the sentence for one planned unit of work.
+    The sentence of a single value does not depend on the taxon, so it is
+    shared by every taxon with the same value.
+    With a cascade, the small model's sentence is kept unless cleaning it
+    leaves nothing, or if the value's rule is 'not as above', as the right
+    sentence is then empty.
+    Returns an empty string when there is nothing to describe.
+    """
+    planned = build_prompt(rules, supp_index, unit)
+    if planned is None:
+        return ""
+    prompt, prompt_version = planned
+    ask = lambda model_name: llm_chat(llm_client, model_name, SYSTEM_MESSAGE, prompt, cache=cache, prompt_version=prompt_version)
+    if cascade is not None:
+        # Single units are ('single', code, value), multi units are ('multi', taxon_name, code)
+        if unit[0] == 'single':
+            code, value = unit[1], unit[2]
+        else:
+            code, value = unit[2], supp_index.multi(unit[1], unit[2])[0]['value']
+        expects_empty = re.search(r'not as above', rule_for_value(rules, code, value)) is not None
+        output = cascade.ask(ask, lambda output: expects_empty or clean_output(output).strip() != "", code)
+    else:
+        output = ask(model_name)
+    # Clean the output
+    return clean_output(output)
+
+
+def plan_units(supp_data, supp_index, df_app2):
+    """
+    Function to plan the LLM calls for every taxon and code.
+    Codes without a value need no call. A single value is described by a
+    ('single', code, value) unit that is shared by all taxa with that value,
+    so the number of calls grows with the number of codes and states rather
+    than the number of taxa. Codes scored with several values (a comma in
+    the value) depend on the taxon's frequencies and get a
+    ('multi', taxon_name, code) unit.
+    Returns a list of (taxon_name, code, unit) in output order, with unit
+    None when there is nothing to describe, and the list of unique units.
+    """
+    plan = []
+    for taxon_name in supp_data.taxon_name.unique():
+        for code in df_app2.code.unique():
+            value = supp_index.value(taxon_name, code)
+            if value == '':
+                unit = None
+            elif ',' in value:
+                unit = ('multi', taxon_name, code)
+            else:
+                unit = ('single', code, value)
+            plan.append((taxon_name, code, unit))
+    units = list(dict.fromkeys(unit for _, _, unit in plan if unit is not None))
+    return plan, units
+
+
 def main():
     # Parse arguments
     args = parse_args()
-    # Set up connection to ollama model on HPC
-    ollama_client = ollama.Client(host='http://127.0.0.1:18199')
     # Read in the input files
     df_app2 = process_appendix2(args.input_file_app2)
     supp_data, tidy_supp_data, multi_qual = process_supp_data(args.input_file_supp_data, args.multi_input_file)
-    # Create an empty list to store the output
-    output_list = []
-    # Iterate over each taxon_name
-    for taxon_name in supp_data.taxon_name.unique():
-        # Iterate over each code in the app2 DataFrame
-        for code in df_app2.code.unique():
-            # Look up subject that relates to code
-            subject = df_app2.loc[df_app2["code"] == code, "subject"].iloc[0]
-            supp_codes = get_supp_codes(tidy_supp_data, code, taxon_name)
-            supp_codes = json.loads(supp_codes)
-            app2_rules = df_app2[df_app2.code == code][["code", "rules"]].to_json(
-                orient='records')
-            # if the value == '' then the output is an empty string. If the value contains
-            # multiple values, then the output is a list of rules that match the values.
-            # if the value contains a single value, then the output is the rule that matches
-            if all(item['value'] == '' for item in supp_codes):
-                output = ""
-            # if the value contains a comma, process as a multi-value case
-            elif any(',' in item['value'] for item in supp_codes):
-                # If value contains comma, run the multi-value prompt using the multi_input_file
-                # Find the corresponding row in multi_qual for this taxon_name and code
-                multi_row = multi_qual[
-                    (multi_qual['taxon_name'] == taxon_name) &
-                    (multi_qual['code'] == code)
-                ]
-                if not multi_row.empty:
-                    subject = df_app2.loc[df_app2["code"] == code, "subject"].iloc[0]
-                    multi_supp_codes = multi_row[["code", "value"]].to_json(orient='records')
-                    multi_supp_codes = json.loads(multi_supp_codes)
-                    other_values = multi_row['other_values'].to_json(orient='records')
-                    frequency = multi_row['frequency'].to_json(orient='records')
-                    num_specimens_scored = multi_row['num_specimens_scored'].to_json(orient='records')
-                    app2_rules = df_app2[df_app2.code == code][["code", "rules"]].to_json(orient='records')
-                    multi_val_prompt = textwrap.dedent(f"""
-                        ### Instructions ###
-                        Use the rules and the value provided to to produce a concise, 
-                        natural-sounding sentence that reflects the dominant trait observed.
-
-                        Each set of rules is a string of semicolon-separated options in the format: 
-                        "Trait description (value)". Match the trait code in the 'value' to 
-                        its description in the rules.
-
-                        - 'frequency': Number of times the dominant trait was observed.
-                        - 'num_specimens_scored': Total specimens observed.
-                        - 'other_values': Other trait codes observed in remaining specimens.
-
-                        Use the frequency and specimen count to adjust your wording:
-                        - If the dominant trait was found in all or nearly all specimens, state it directly.
-                        - If it was found in most but not all, use qualifiers like "usually", "sometimes".
-                        - If found in a very small proportion of specimens, use "rarely".
-
-                        **Output a single sentence only. No labels, no extra text.**
-                        
-                        ### Materials ###
-                        - Rules: {app2_rules}
-                        - Value: {multi_supp_codes}
-                        - frequency: {frequency}
-                        - num_specimens_scored: {num_specimens_scored}
-                        - other_values: {other_values}
-
-                        Use the following examples to guide your response:
-
-                        ### Example 1 ###
-                        Input:
-                        - Rules: "Stems solitary (0); stems clustered (1)"
-                        - Value: {{"code": "solclu", "value": "1"}}
-                        - frequency: 3
-                        - num_specimens_scored: 4
-                        - other_values: [0]
-
-                        Output: "Stems clustered, rarely solitary."
-
-                        ### Example 2 ###
-                        Input:
-                        - Rules: "Proximalmost pinnae swept back across the sheath (on adult plants only) (0); 
-                          proximalmost pinnae not swept back across the sheath (1)"
-                        - Value: {{"code": "sweptb", "value": 1.0}}
-                        - frequency: 19
-                        - num_specimens_scored: 29
-                        - other_values: [0]
-
-                        Output: "Proximalmost pinnae sometimes swept back across the sheath."
-                    """)
-                    output = llm_chat(ollama_client, args.model_name, SYSTEM_MESSAGE, multi_val_prompt)
-                    # Clean the output
-                    output = clean_output(output)
-                    # Store the output in a dictionary only if output is not empty
-                    if output.strip() != "":
-                        append_output(output_list, taxon_name, output, subject)
-                else:
-                    output = ""
-            else:
-                single_val_prompt = textwrap.dedent(f"""
-                    ### Instructions ###
-                    Using the "rules" in {app2_rules} and the corresponding "value"
-                    in {supp_codes} output the rule that matches the value.
-                    Return only an output sentence, NO EXTRA TEXT.
-
-                    ### Example ###
-                    Using {{"code":"rachil","rules":"Petioles and rachises with at
-                    least some long, straight, flat, usually grouped spines
-                    abaxially (0); petioles and rachises with whorls of long,
-                    straight, flat spines (1); rachises without long, straight,
-                    flat spines abaxially (2)"}} and {{"code":"rachil","value":"2"}},
-                    the output would be 'rachises without long, straight, flat
-                    spines abaxially' only.
-                """)
-                output = llm_chat(ollama_client, args.model_name, SYSTEM_MESSAGE, single_val_prompt)
-                # Clean the output
-                output = clean_output(output)
-                # Store the output in a dictionary and append to output list
-                append_output(output_list, taxon_name, output, subject)
-    # Create a DataFrame from the output list
-    df_output = pd.DataFrame(output_list)
-    df_frucol = process_frucol(args.input_file_supp_data)
-    df_output = pd.concat([df_output, df_frucol], ignore_index=True)
-    # Remove any rows where the output_sentence is an empty string
-    df_output = df_output[df_output["output_sentence"].str.strip() != ""]
-    # Save the output to a CSV file
-    df_output.to_csv(args.output_file, index=False)
+    # Index the values, multi-value rows and rules once, so each unit is a dictionary lookup
+    supp_index = SuppDataIndex(tidy_supp_data, multi_qual)
+    rules = index_rules(df_app2)
+    # Plan the calls up front so identical single-value prompts are only sent once
+    plan, units = plan_units(supp_data, supp_index, df_app2)
+    # Single values with a known state are rendered directly from the state table
+    unit_outputs = {}
+    if args.states_file:
+        states = read_states(args.states_file)
+        unit_outputs = {
+            unit: render_state(states[tuple(unit[1:])])
+            for unit in units
+            if unit[0] == 'single' and tuple(unit[1:]) in states
+        }
+    llm_units = [unit for unit in units if unit not in unit_outputs]
+    if args.plan:
+        prompts = [build_prompt(rules, supp_index, unit) for unit in llm_units]
+        prompts = [planned[0] for planned in prompts if planned is not None]
+        report_plan(args, 'app2_descriptions', SYSTEM_MESSAGE, prompts, len(plan) - len(prompts))
+        return
+    print(f"Describing {len(plan)} taxon and code pairs with {len(unit_outputs)} rendered states and {len(llm_units)} LLM calls")
+    # Set up the model, cache, metrics, checkpoint and cascade, closed even if the run fails
+    with open_session(args, 'app2_descriptions') as (llm_client, cache, checkpoint, cascade):
+        # The units are independent, so they can be sent to the model concurrently
+        outputs = run_jobs(
+            lambda unit: describe_unit(llm_client, cache, args.model_name, rules, supp_index, unit, cascade=cascade),
+            llm_units,
+            args.concurrency,
+            checkpoint,
+            cascade,
+        )
+        unit_outputs.update(zip(llm_units, outputs))
+        # Look up the subject that relates to each code
+        first_rows = df_app2.drop_duplicates('code')
+        subjects = dict(zip(first_rows.code, first_rows.subject))
+        # Create an empty list to store the output
+        output_list = []
+        for taxon_name, code, unit in plan:
+            subject = subjects[code]
+            # Fan the shared sentence back out to every taxon
+            output = unit_outputs[unit] if unit is not None else ""
+            # Store the output in a dictionary and append to output list
+            append_output(output_list, taxon_name, output, subject)
+        # Create a DataFrame from the output list
+        df_output = pd.DataFrame(output_list)
+        df_frucol = process_frucol(args.input_file_supp_data)
+        df_output = pd.concat([df_output, df_frucol], ignore_index=True)
+        # Remove any rows where the output_sentence is an empty string
+        df_output = df_output[df_output["output_sentence"].str.strip() != ""]
+        # Save the output to a CSV file
+        df_output.to_csv(args.output_file, index=False)
+        # The output is saved, so the checkpoint is no longer needed
+        checkpoint.remove()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,9 +1,10 @@
 import argparse
 import json
-import ollama
 import pandas as pd
+import re
 import textwrap
-from scripts.utils import llm_chat, append_output
+from scripts.session import open_session
+from scripts.utils import add_llm_args, llm_chat, append_output, run_jobs, report_plan, parse_json_output, build_json_schema
 
 # Ensure that entire descriptions can be printed and used
 pd.set_option('display.max_colwidth', None)
@@ -15,13 +16,31 @@ Clarity and specificity are essential. Ensure the style is concise and technical
 Follow the style and tone of formal taxonomic monographs.
 """
 
+# The instructions, followed by the sentences to combine
 PROMPT = textwrap.dedent(f"""
-Combine the following sentences / clauses as concisely as possible:\n {{sentences}}
+Combine the sentences / clauses below as concisely as possible.
 This must be written in the style of a botanical monograph.  
 Avoid excessive negations or long lists of features that are not present unless those absences are crucial for species identification. 
 Retain all measurements. Return the combination with NO EXTRA TEXT.
+Sentences / clauses:\n {{sentences}}
 """)
 
+# Bump to invalidate cached responses for this prompt template
+PROMPT_VERSION = "combine_descriptions-v2"
+
+# Used with --whole_taxon to combine every subject of a taxon in one call
+TAXON_PROMPT = textwrap.dedent(f"""
+For each subject below, combine its sentences / clauses as concisely as possible.
+This must be written in the style of a botanical monograph.
+Avoid excessive negations or long lists of features that are not present unless those absences are crucial for species identification.
+Retain all measurements. Keep each subject's information under that subject.
+Return a JSON object with one key per subject and the combined text as its value, with NO EXTRA TEXT.
+Sentences / clauses by subject:\n {{subjects}}
+""")
+
+# Bump to invalidate cached responses for this prompt template
+TAXON_PROMPT_VERSION = "combine_descriptions-taxon-v1"
+
 # Define subject order as a constant
 SUBJECT_ORDER = [
     'Stem',
@@ -54,6 +73,8 @@ def parse_args():
     parser.add_argument('output_file', help="Path to the output CSV file where the descriptions are saved")
     parser.add_argument('--model_name', default='llama3.3', help="Name of the model to use for the chat completion (default: 'llama3.3')")
     parser.add_argument('--subject_sentences', action='store_true', help="If set, the output will contain subject separation.")
+    parser.add_argument('--whole_taxon', action='store_true', help="If set, all subjects of a taxon are combined in one LLM call instead of one call per subject.")
+    add_llm_args(parser)
     return parser.parse_args()
 
 
@@ -107,17 +128,105 @@ def format_output(output_list, args, SUBJECT_ORDER):
     return df_output
 
 
+def build_prompt(sentences):
+    """
+    Function to build the prompt combining the sentences of one subject.
+    """
+    prompt_outline = PROMPT
+    return prompt_outline.format(sentences=sentences)
+
+
+def keeps_numbers(sentences, output):
+    """
+    Function to check that a combined text keeps every number of the
+    sentences it was made from, e.g. the measurements of Appendix I.
+    """
+    numbers = set(re.findall(r"\d+(?:\.\d+)?", " ".join(sentences)))
+    return bool(output.strip()) and numbers <= set(re.findall(r"\d+(?:\.\d+)?", output))
+
+
+def combine_subject(llm_client, cache, model_name, sentences, cascade=None, subject=None):
+    """
+    Function to combine the sentences of one subject for one taxon.
+    With a cascade, the small model's text is kept only if it keeps every
+    number of the sentences.
+    """
+    # If there is only one sentence, just return the sentence
+    if len(sentences) == 1:
+        return sentences[0]
+    # Set up the prompt
+    prompt = build_prompt(json.dumps(sentences))
+    # If "sentences" contains multiple sentences, combine them using a LLM
+    ask = lambda model_name: llm_chat(llm_client, model_name, SYSTEM_MESSAGE, prompt, cache=cache, prompt_version=PROMPT_VERSION)
+    if cascade is not None:
+        return cascade.ask(ask, lambda output: keeps_numbers(sentences, output), str(subject))
+    return ask(model_name)
+
+
+def build_taxon_prompt(subject_sentences):
+    """
+    Function to build the prompt combining the sentences of several subjects of one taxon.
+    """
+    prompt_outline = TAXON_PROMPT
+    return prompt_outline.format(subjects=json.dumps(subject_sentences))
+
+
+def combine_taxon(llm_client, cache, model_name, subject_sentences, cascade=None):
+    """
+    Function to combine the sentences of every subject of one taxon in a
+    single call. subject_sentences is a dict of subject to its sentences.
+    Subjects with one sentence are kept as they are, and subjects missing
+    from the answer are combined on their own.
+    Returns a dict of subject to combined text.
+    """
+    combined = {
+        subject: sentences[0]
+        for subject, sentences in subject_sentences.items()
+        if len(sentences) == 1
+    }
+    to_combine = {
+        subject: sentences
+        for subject, sentences in subject_sentences.items()
+        if len(sentences) > 1
+    }
+    if to_combine:
+        prompt = build_taxon_prompt(to_combine)
+        # Constrain the output to a JSON object with one key per subject
+        schema = build_json_schema(list(to_combine))
+        ask = lambda model_name: llm_chat(llm_client, model_name, SYSTEM_MESSAGE, prompt, cache=cache, prompt_version=TAXON_PROMPT_VERSION, format=schema)
+        if cascade is not None:
+            # The small model's answer must be valid JSON keeping the numbers of every subject
+            def check(output):
+                parsed = parse_json_output(output) or {}
+                return all(
+                    isinstance(parsed.get(subject), str) and keeps_numbers(sentences, parsed[subject])
+                    for subject, sentences in to_combine.items()
+                )
+            # Go straight to the large model if any of the subjects is hard
+            output = cascade.ask(ask, check, 'whole_taxon', hard=bool(cascade.hard_codes.intersection(to_combine)))
+        else:
+            output = ask(model_name)
+        parsed = parse_json_output(output) or {}
+        for subject, sentences in to_combine.items():
+            text = parsed.get(subject)
+            if isinstance(text, str) and text.strip():
+                combined[subject] = text.strip()
+            else:
+                combined[subject] = combine_subject(llm_client, cache, model_name, sentences, cascade, subject)
+    # Keep the subjects in their original order
+    return {subject: combined[subject] for subject in subject_sentences}
+
+
 def main():
     # Parse arguments
     args = parse_args()
-    # Set up connection to ollama model on HPC
-    ollama_client = ollama.Client(host='http://127.0.0.1:18199')
     # Read in the input files
     all_descriptions = combine_descriptions(args.input_file_app1, args.input_file_app2)
-    # Create an empty list to store the output
-    output_list = []
+    # Collect the sentences for each taxon and subject
+    taxon_subjects = {}
     # Iterate over each taxon_name
     for taxon_name in all_descriptions.taxon_name.unique():
+        taxon_subjects[taxon_name] = {}
         # Iterate over each subject in the descriptions
         for subject in all_descriptions.subject.unique():
             # Join sentences for each subject
@@ -129,22 +238,51 @@ def main():
             # Skip if sentences is empty
             if not sentences:
                 continue
-            sentences = json.dumps(sentences)
-            # Set up the prompt
-            prompt_outline = PROMPT
-            prompt = prompt_outline.format(sentences=sentences)
-            # If "sentences" contains multiple sentences, combine them using a LLM
-            if len(sentences) > 1:
-                output = llm_chat(ollama_client, args.model_name, SYSTEM_MESSAGE, prompt)
-            # If there is only one sentence, just return the sentence
+            taxon_subjects[taxon_name][subject] = sentences
+    if args.whole_taxon:
+        # Each taxon is one unit of work
+        units = list(taxon_subjects)
+        worker = lambda taxon_name: combine_taxon(llm_client, cache, args.model_name, taxon_subjects[taxon_name], cascade)
+    else:
+        # Each taxon and subject pair is one unit of work
+        units = [(taxon_name, subject) for taxon_name, subjects in taxon_subjects.items() for subject in subjects]
+        worker = lambda unit: combine_subject(llm_client, cache, args.model_name, taxon_subjects[unit[0]][unit[1]], cascade, unit[1])
+    if args.plan:
+        # Subjects with a single sentence need no call
+        if args.whole_taxon:
+            prompts = [
+                build_taxon_prompt({subject: sentences for subject, sentences in subjects.items() if len(sentences) > 1})
+                for subjects in taxon_subjects.values()
+                if any(len(sentences) > 1 for sentences in subjects.values())
+            ]
+        else:
+            prompts = [
+                build_prompt(json.dumps(taxon_subjects[taxon_name][subject]))
+                for taxon_name, subject in units
+                if len(taxon_subjects[taxon_name][subject]) > 1
+            ]
+        report_plan(args, 'combine_descriptions', SYSTEM_MESSAGE, prompts, len(units) - len(prompts))
+        return
+    # Set up the model, cache, metrics, checkpoint and cascade, closed even if the run fails
+    with open_session(args, 'combine_descriptions') as (llm_client, cache, checkpoint, cascade):
+        # The units are independent, so they can be sent to the model concurrently
+        outputs = run_jobs(worker, units, args.concurrency, checkpoint, cascade)
+        # Create an empty list to store the output
+        output_list = []
+        for unit, output in zip(units, outputs):
+            if args.whole_taxon:
+                for subject, subject_output in output.items():
+                    append_output(output_list, unit, subject_output, subject)
             else:
-                output = sentences[0]
-            # Store the output in a dictionary and append to output list
-            append_output(output_list, taxon_name, output, subject)
-    # Format the output DataFrame
-    df_output = format_output(output_list, args, SUBJECT_ORDER)
-    # Save output DataFrame as a csv file
-    df_output.to_csv(args.output_file, index=False)
+                taxon_name, subject = unit
+                # Store the output in a dictionary and append to output list
+                append_output(output_list, taxon_name, output, subject)
+        # Format the output DataFrame
+        df_output = format_output(output_list, args, SUBJECT_ORDER)
+        # Save output DataFrame as a csv file
+        df_output.to_csv(args.output_file, index=False)
+        # The output is saved, so the checkpoint is no longer needed
+        checkpoint.remove()
 
 if __name__ == "__main__":
     main()
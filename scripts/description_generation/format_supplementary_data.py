@@ -31,129 +31,163 @@ def read_supp_data(input_file):
 
 
 def extract_values(df):
-    """Function to extract mean, min, and max values from the supplementary data matrix."""
-    def get_value(df, func, round_dict=None):
-        result = (
-            df
-            .groupby('taxon_name')
-            .agg(func)
-            .round(1)
-            .replace(to_replace=np.nan, value='')
-        )
-        if round_dict:
-            result = result.round(round_dict)
-        return result
-
-    mean_vals = get_value(df, 'mean', {'numpin': 0})
-    min_vals = get_value(df, 'min', {'numpin': 0})
-    max_vals = get_value(df, 'max', {'numpin': 0})
-
+    """
+    Function to extract the mean, min, and max values of each taxon from the
+    supplementary data matrix in one grouped pass.
+    """
+    stats = df.groupby('taxon_name').agg(['mean', 'min', 'max']).round(1)
+    mean_vals = stats.xs('mean', axis=1, level=1)
+    min_vals = stats.xs('min', axis=1, level=1)
+    max_vals = stats.xs('max', axis=1, level=1)
+    # Round numpin to whole numbers when every taxon has a value (a blank
+    # turned the column into text, which round() skipped)
+    if 'numpin' in mean_vals.columns and mean_vals['numpin'].notna().all():
+        mean_vals, min_vals, max_vals = (vals.round({'numpin': 0}) for vals in (mean_vals, min_vals, max_vals))
     return mean_vals, min_vals, max_vals
 
 
-def format_qualitative_data_numbers(supp_data):
-    """Format qualitative data with multiple numbers per code."""
-    qualitative_data = (
-        supp_data
-        .loc[:, ['taxon_name'] + supp_data.loc[:, 'solclu':'embryo'].columns.to_list()]
-        .replace(to_replace=np.nan, value='')
-        .groupby('taxon_name')
-        .agg(lambda x: list(set(filter(lambda v: v != '', x))))
-        .map(lambda x: ', '.join(map(str, x)))
-    )
-    return qualitative_data
-
-
-def format_quantitative_values(mean, min_val, max_val):
-    """Define a function to remove cases where there are no ranges and format ranges as 'mean(min-max)'."""
-    if mean == min_val == max_val:
-        return str(mean)
-    return f"{mean}({min_val}-{max_val})"
-
-def extract_qualitative_multi(supp_data, output_file_qual_multi):
+def format_quantitative_data(mean_vals, min_vals, max_vals):
+    """
+    Function to format the values as 'mean(min-max)', or only the mean when
+    there is no range. Taxa without values are left blank.
+    """
+    mean_text = mean_vals.astype(str)
+    ranges = mean_text + '(' + min_vals.astype(str) + '-' + max_vals.astype(str) + ')'
+    no_range = (mean_vals == min_vals) & (min_vals == max_vals)
+    return ranges.where(~no_range, mean_text).where(mean_vals.notna(), '')
+
+
+def join_states(supp_data, columns):
+    """
+    Function to join the distinct values scored for each taxon in each of the
+    given columns, in sorted order, e.g. '1.0, 2.0'. Taxa without values are
+    left blank.
+    """
+    # Number the taxa in the sorted order of groupby
+    taxa = supp_data.groupby('taxon_name').size().index
+    taxon_ids = taxa.get_indexer(supp_data['taxon_name'])
+    joined = {}
+    for code in columns:
+        # Number the values of the column in sorted order
+        value_ids, uniques = pd.factorize(supp_data[code], sort=True)
+        labels = np.array([str(value) for value in uniques], dtype=object)
+        scored = (taxon_ids >= 0) & (value_ids >= 0)
+        scored[scored] = labels[value_ids[scored]] != ''
+        # Each distinct taxon and value once, sorted by taxon then value
+        pairs = np.unique(taxon_ids[scored] * len(uniques) + value_ids[scored])
+        taxon_of, value_of = np.divmod(pairs, max(len(uniques), 1))
+        starts = np.flatnonzero(np.diff(taxon_of, prepend=-1))
+        cells = np.full(len(taxa), '', dtype=object)
+        if len(starts):
+            cells[taxon_of[starts]] = [', '.join(chunk) for chunk in np.split(labels[value_of], starts[1:])]
+        joined[code] = cells
+    return pd.DataFrame(joined, index=taxa, dtype=str)
+
+
+def extract_qualitative_multi(supp_data):
+    """
+    Function to summarise the qualitative codes that were scored with more
+    than one value for a taxon: the most common value (the lowest one on a
+    tie, like mode()), its frequency, the number of specimens and of
+    specimens scored, and the other values. The values of each column are
+    numbered in sorted order, so the counts are grouped operations on a
+    long-format frame of integers rather than a loop over taxa and codes.
+    """
     # Get the list of qualitative trait columns
     qualitative_cols = supp_data.loc[:, 'solclu':'embryo'].columns.to_list()
-
-    # Prepare a list to collect results
-    qualitative_results = []
-
-    # Group by taxon_name
-    grouped = supp_data.groupby('taxon_name')
-
-    for taxon, group in grouped:
-        num_specimens = len(group)
-        for code in qualitative_cols:
-            # calculate the number of specimens scored for each code
-            num_specimens_scored = group[code].notna().sum()
-            values = group[code].dropna()
-            if values.empty:
-                most_common = ''
-                freq = 0
-                other_values = ''
-            else:
-                most_common = values.mode().iloc[0]
-                freq = (values == most_common).sum()
-                # Find other unique values assigned (excluding the most common)
-                other_vals = set(values.unique()) - {most_common}
-                other_values = ', '.join(map(str, sorted(other_vals))) if other_vals else ''
-            qualitative_results.append({
-                'taxon_name': taxon,
-                'code': code,
-                'value': most_common,
-                'frequency': freq,
-                'num_specimens': num_specimens,
-                'num_specimens_scored': num_specimens_scored,
-                'other_values': other_values
-            })
-
-    qualitative_data_numbers_multi = pd.DataFrame(
-        qualitative_results,
-        columns=['taxon_name', 'code', 'value', 'frequency', 'num_specimens', 'num_specimens_scored', 'other_values']
+    # Number the taxa in the sorted order of groupby
+    num_specimens = supp_data.groupby('taxon_name').size()
+    taxon_ids = num_specimens.index.get_indexer(supp_data['taxon_name'])
+    # Number the values of each column in sorted order, keeping each
+    # column's own type (e.g. 1 or 1.0) for the output
+    long_parts = []
+    value_tables = []
+    offset = 0
+    for code_id, code in enumerate(qualitative_cols):
+        value_ids, uniques = pd.factorize(supp_data[code], sort=True)
+        long_parts.append(pd.DataFrame({
+            'taxon': taxon_ids,
+            'code': code_id,
+            'value': np.where(value_ids >= 0, value_ids + offset, -1),
+        }))
+        value_tables.append(np.asarray(uniques, dtype=object))
+        offset += len(uniques)
+    values = np.concatenate(value_tables) if value_tables else np.array([], dtype=object)
+    labels = np.array([str(value) for value in values], dtype=object)
+    # One row per scored cell, keyed by its row number in a table with one
+    # row per taxon and code
+    long_data = pd.concat(long_parts, ignore_index=True)
+    long_data = long_data[(long_data['taxon'] >= 0) & (long_data['value'] >= 0)]
+    keys = long_data['taxon'] * len(qualitative_cols) + long_data['code']
+    # Count each value of each taxon and code, lowest value first
+    counts = long_data.groupby([keys.rename('key'), 'value']).size().rename('frequency').reset_index()
+    num_specimens_scored = counts.groupby('key')['frequency'].sum()
+    # The most common value is the first one with the highest count
+    top_frequency = counts.groupby('key')['frequency'].transform('max')
+    top = counts[counts['frequency'] == top_frequency].drop_duplicates('key')
+    # The other values, already in sorted order, joined per taxon and code
+    others = counts.drop(top.index)
+    other_keys = others['key'].to_numpy()
+    starts = np.flatnonzero(np.diff(other_keys, prepend=-1))
+    other_labels = labels[others['value'].to_numpy()]
+    other_values = pd.Series(
+        [', '.join(chunk) for chunk in np.split(other_labels, starts[1:])] if len(starts) else [],
+        index=other_keys[starts],
+        dtype=str,
     )
-    # remove rows where 'other_values' is empty
-    qualitative_data_numbers_multi = qualitative_data_numbers_multi[qualitative_data_numbers_multi['other_values'] != '']
-    qualitative_data_numbers_multi.to_csv(output_file_qual_multi, index=False)
-
-
-def format_frucol(supp_data):
-    fruit_colour = (
-        supp_data
-        .loc[:, ['taxon_name', 'frucol']]
-        .replace(to_replace=np.nan, value='')
-        .groupby('taxon_name')
-        .agg(lambda x: list(set(filter(lambda v: v != '', x))))
-        .map(lambda x: ', '.join(map(str, x)))
+    # Only keep the taxa and codes with other values
+    top = top.set_index('key').loc[other_values.index]
+    taxa, codes = np.divmod(other_values.index.to_numpy(), len(qualitative_cols))
+    qualitative_data_numbers_multi = pd.DataFrame(
+        {
+            'taxon_name': num_specimens.index[taxa].to_list(),
+            'code': [qualitative_cols[code_id] for code_id in codes],
+            'value': pd.Series(values[top['value'].to_numpy()], index=other_values.index, dtype=object),
+            'frequency': top['frequency'].to_numpy(),
+            'num_specimens': num_specimens.to_numpy()[taxa],
+            'num_specimens_scored': num_specimens_scored.loc[other_values.index].to_numpy(),
+            'other_values': other_values,
+        },
+        # Same row numbers as one row per taxon and code
+        index=other_values.index,
     )
-    return fruit_colour
+    return qualitative_data_numbers_multi
 
 
-def main():
-    # Parse arguments
-    args = parse_args()
+def format_supp_data(input_file):
+    """
+    Function to format the supplementary data matrix. Returns the formatted
+    data (one row per taxon) and the qualitative data with multiple numbers
+    per code.
+    """
     # Call the function to read the supplementary data
-    supp_data = read_supp_data(args.input_file)
+    supp_data = read_supp_data(input_file)
     # Convert all column headings to lowercase for consistency
     supp_data.columns = supp_data.columns.str.lower()
     # Extract the mean, min, and max values
     mean_vals, min_vals, max_vals = extract_values(supp_data.loc[:, 'taxon_name':'fruitdiam'])
-    # Apply the function element-wise to the DataFrame
-    quantitative_data = pd.DataFrame(
-        np.vectorize(format_quantitative_values)(mean_vals, min_vals, max_vals),
-        index=mean_vals.index, columns=mean_vals.columns
-    )
-    # Select the qualitative traits and format when there are multiple numbers per code
-    qualitative_data_numbers = (format_qualitative_data_numbers(supp_data))
-    # Oupputput the qualitative data with multiple numbers per code
-    extract_qualitative_multi(supp_data, args.output_file_qual_multi)
-    # Separate fruit colour as it is not assigned a numerical variable
-    fruit_colour = format_frucol(supp_data)
-    # Merge the qualitative traits (qualitative_data_numbers) with fruit colour (fruit_colour)
-    qualitative_data = pd.merge(qualitative_data_numbers, fruit_colour, on='taxon_name')
+    # Format the quantitative traits as 'mean(min-max)'
+    quantitative_data = format_quantitative_data(mean_vals, min_vals, max_vals)
+    # Join the values of the qualitative traits and fruit colour, which is not
+    # assigned a numerical variable
+    qualitative_data = join_states(supp_data, supp_data.loc[:, 'solclu':'embryo'].columns.to_list() + ['frucol'])
+    # Extract the qualitative data with multiple numbers per code
+    qualitative_data_numbers_multi = extract_qualitative_multi(supp_data)
     # Merge quantitative_data (quantitative traits) with qualitative_data (qualitative traits)
     formatted_supp_data = pd.merge(quantitative_data, qualitative_data, on='taxon_name')
     # Remove .0 from numpin output
     if 'numpin' in formatted_supp_data.columns:
         formatted_supp_data['numpin'] = formatted_supp_data['numpin'].astype(str).str.replace('.0', '', regex=False)
+    return formatted_supp_data, qualitative_data_numbers_multi
+
+
+def main():
+    # Parse arguments
+    args = parse_args()
+    # Format the supplementary data
+    formatted_supp_data, qualitative_data_numbers_multi = format_supp_data(args.input_file)
+    # Output the qualitative data with multiple numbers per code
+    qualitative_data_numbers_multi.to_csv(args.output_file_qual_multi, index=False)
     formatted_supp_data.to_csv(args.output_file)
 
 if __name__ == "__main__":
@@ -0,0 +1,234 @@
+import argparse
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import pandas as pd
+from scripts import telemetry
+from scripts.backends import ModelDeferred
+from scripts.session import open_session
+from scripts.utils import SuppDataIndex, add_llm_args, append_output, iter_jobs
+from . import app1_descriptions, app2_descriptions, combine_descriptions
+from .format_supplementary_data import format_supp_data
+
+
+def parse_args():
+    """
+    Function to parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Runs format_supplementary_data, app1_descriptions, app2_descriptions and combine_descriptions in one process, writing each taxon's description as soon as it is ready.")
+    parser.add_argument('input_file', help="Path to the input Excel file containing the supplementary data matrix")
+    parser.add_argument('input_file_app1', help="Path to the input text file containing the appendix 1")
+    parser.add_argument('input_file_app2', help="Path to the input text file containing the appendix 2")
+    parser.add_argument('output_file', help="Path to the output CSV file where the descriptions are saved")
+    parser.add_argument('--model_name', default='llama3.3', help="Name of the model to use for the chat completion (default: 'llama3.3')")
+    parser.add_argument('--states_file', default=None, help="Path to the CSV file of appendix 2 states written by clean_appendix.py. If set, single values are rendered from the states.")
+    parser.add_argument('--app1_llm', action='store_true', help="If set, the Appendix I sentences are written by the LLM instead of from a template.")
+    parser.add_argument('--whole_taxon', action='store_true', help="If set, all subjects of a taxon are combined in one LLM call.")
+    parser.add_argument('--subject_sentences', action='store_true', help="If set, the output will contain subject separation.")
+    add_llm_args(parser)
+    return parser.parse_args()
+
+
+class SharedResults:
+    """
+    Results of units of work shared between taxa, e.g. the sentence for a
+    single value of an Appendix II code. Each unit is computed once, by the
+    first taxon that needs it, and the other taxa wait for that result. A
+    unit that fails is computed again by the next taxon that needs it, e.g.
+    in the next pass of a scheduled cascade.
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def get(self, unit, compute):
+        """
+        Function to return the result of a unit, computing it if no other taxon has.
+        """
+        with self._lock:
+            future = self._futures.get(unit)
+            owner = future is None
+            if owner:
+                future = self._futures[unit] = Future()
+        if owner:
+            try:
+                future.set_result(compute())
+            except Exception as e:
+                with self._lock:
+                    del self._futures[unit]
+                future.set_exception(e)
+        return future.result()
+
+
+class Pipeline:
+    """
+    The inputs, model connection and shared results used to describe each taxon.
+    """
+
+    def __init__(self, args, llm_client, cache, stage_executor, cascade=None):
+        self.args = args
+        self.llm_client = llm_client
+        self.cache = cache
+        self.cascade = cascade
+        # Runs the Appendix I stage of a taxon alongside its Appendix II stage
+        self.stage_executor = stage_executor
+        self.shared = SharedResults()
+        # Format the supplementary data in memory instead of writing it to CSV files
+        formatted_supp_data, supp_data_multi = format_supp_data(args.input_file)
+        formatted_supp_data = formatted_supp_data.reset_index()
+        # Appendix I inputs
+        self.df_app1 = app1_descriptions.process_appendix1(args.input_file_app1)
+        _, tidy_app1 = app1_descriptions.process_supp_data(formatted_supp_data)
+        self.app1_index = SuppDataIndex(tidy_app1)
+        self.app1_traits = app1_descriptions.index_traits(self.df_app1)
+        self.traits = self.df_app1.drop_duplicates('code').set_index('code')
+        # Appendix II inputs, with the work planned across all taxa so shared units are only sent once
+        self.df_app2 = app2_descriptions.process_appendix2(args.input_file_app2)
+        supp_data, tidy_app2, multi_qual = app2_descriptions.process_supp_data(formatted_supp_data, supp_data_multi)
+        self.app2_index = SuppDataIndex(tidy_app2, multi_qual)
+        self.app2_rules = app2_descriptions.index_rules(self.df_app2)
+        plan, _ = app2_descriptions.plan_units(supp_data, self.app2_index, self.df_app2)
+        self.app2_plan = {}
+        for taxon_name, code, unit in plan:
+            self.app2_plan.setdefault(taxon_name, []).append((code, unit))
+        self.states = app2_descriptions.read_states(args.states_file) if args.states_file else {}
+        self.df_frucol = app2_descriptions.process_frucol(formatted_supp_data)
+        self.taxon_names = list(supp_data.taxon_name.unique())
+        # Look up the subject of each code from its first row, as the individual scripts do
+        first_rows_app1 = self.df_app1.drop_duplicates('code')
+        first_rows_app2 = self.df_app2.drop_duplicates('code')
+        self.subjects = {
+            **dict(zip(first_rows_app1.code, first_rows_app1.subject)),
+            **dict(zip(first_rows_app2.code, first_rows_app2.subject)),
+        }
+
+    def describe_app1(self, taxon_name):
+        """
+        Function to write the Appendix I sentences of one taxon.
+        """
+        output_list = []
+        for code in self.df_app1.code.unique():
+            if self.args.app1_llm:
+                output = app1_descriptions.describe_code(self.llm_client, self.cache, self.args.model_name, self.app1_traits, self.app1_index, taxon_name, code, self.cascade)
+            else:
+                output = app1_descriptions.render_sentence(self.traits.at[code, 'description'], self.traits.at[code, 'unit'], self.app1_index.value(taxon_name, code))
+            append_output(output_list, taxon_name, output, self.subjects[code])
+        return output_list
+
+    def describe_app1_in_context(self, taxon_name):
+        """
+        Function to write the Appendix I sentences of one taxon on a stage
+        worker, recording its calls against the taxon and stage.
+        """
+        with telemetry.call_context(unit=taxon_name, stage='app1_descriptions'):
+            return self.describe_app1(taxon_name)
+
+    def describe_shared(self, unit):
+        """
+        Function to write the sentence of an Appendix II unit shared between
+        taxa, recording its calls against the unit rather than the taxon.
+        """
+        with telemetry.call_context(unit=unit):
+            try:
+                return app2_descriptions.describe_unit(self.llm_client, self.cache, self.args.model_name, self.app2_rules, self.app2_index, unit, self.cascade)
+            except ModelDeferred:
+                # The unit is described again in the next pass
+                self.cascade.forget(unit)
+                raise
+
+    def describe_app2(self, taxon_name):
+        """
+        Function to write the Appendix II sentences of one taxon.
+        """
+        output_list = []
+        for code, unit in self.app2_plan.get(taxon_name, []):
+            if unit is None:
+                output = ""
+            elif unit[0] == 'single' and tuple(unit[1:]) in self.states:
+                output = app2_descriptions.render_state(self.states[tuple(unit[1:])])
+            else:
+                output = self.shared.get(unit, lambda unit=unit: self.describe_shared(unit))
+            append_output(output_list, taxon_name, output, self.subjects[code])
+        for output in self.df_frucol[self.df_frucol.taxon_name == taxon_name].output_sentence:
+            append_output(output_list, taxon_name, output, 'Fruit')
+        return output_list
+
+    def combine(self, taxon_name, output_list):
+        """
+        Function to combine the sentences of one taxon by subject.
+        """
+        # Group the non-empty sentences by subject, Appendix I sentences first
+        subject_sentences = {}
+        for row in output_list:
+            if str(row['output_sentence']).strip() != "":
+                subject_sentences.setdefault(row['subject'], []).append(row['output_sentence'])
+        if self.args.whole_taxon:
+            combined = combine_descriptions.combine_taxon(self.llm_client, self.cache, self.args.model_name, subject_sentences, self.cascade)
+        else:
+            combined = {
+                subject: combine_descriptions.combine_subject(self.llm_client, self.cache, self.args.model_name, sentences, self.cascade, subject)
+                for subject, sentences in subject_sentences.items()
+            }
+        combined_list = []
+        for subject, output in combined.items():
+            append_output(combined_list, taxon_name, output, subject)
+        return combined_list
+
+    def describe_taxon(self, taxon_name):
+        """
+        Function to run every stage for one taxon. Returns the output rows.
+        """
+        # The Appendix I and II sentences do not depend on each other, so they
+        # are written concurrently and combined once both are done
+        app1_future = self.stage_executor.submit(self.describe_app1_in_context, taxon_name)
+        # Calls are recorded against the stage that made them
+        with telemetry.call_context(unit=taxon_name):
+            with telemetry.call_context(stage='app2_descriptions'):
+                try:
+                    app2_list = self.describe_app2(taxon_name)
+                finally:
+                    # Do not leave the Appendix I stage running if this one fails
+                    wait([app1_future])
+            # Keep the Appendix I sentences first
+            output_list = app1_future.result() + app2_list
+            with telemetry.call_context(stage='combine_descriptions'):
+                combined_list = self.combine(taxon_name, output_list)
+        if not combined_list:
+            return []
+        df_output = combine_descriptions.format_output(combined_list, self.args, combine_descriptions.SUBJECT_ORDER)
+        if 'subject' in df_output:
+            # The subject is categorical, keep it as text for the checkpoint
+            df_output['subject'] = df_output['subject'].astype(str)
+        return df_output.to_dict(orient='records')
+
+
+def main():
+    # Parse arguments
+    args = parse_args()
+    if args.plan:
+        raise SystemExit("--plan is not supported by run_pipeline, as the combine calls depend on the earlier stages. Use --plan with the individual scripts.")
+    # Set up the model, cache, metrics, checkpoint and cascade, closed even if the run fails
+    with open_session(args, 'run_pipeline') as (llm_client, cache, checkpoint, cascade):
+        # The Appendix I stage has its own workers, so a taxon waiting for it
+        # never holds a worker the stage needs
+        with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as stage_executor:
+            # Read and format the inputs
+            pipeline = Pipeline(args, llm_client, cache, stage_executor, cascade)
+            # Taxa are described concurrently, each one flowing through every
+            # stage on its own, and saved to the checkpoint as soon as it is done
+            results = iter_jobs(pipeline.describe_taxon, pipeline.taxon_names, args.concurrency, checkpoint, cascade)
+            # Write each taxon as soon as it is ready, keeping the taxa in order
+            header = True
+            if os.path.exists(args.output_file):
+                os.remove(args.output_file)
+            for i, (taxon_name, rows) in enumerate(zip(pipeline.taxon_names, results), start=1):
+                if rows:
+                    pd.DataFrame(rows).to_csv(args.output_file, mode='a', header=header, index=False)
+                    header = False
+                print(f"Described {taxon_name} ({i}/{len(pipeline.taxon_names)})")
+        # The output is saved, so the checkpoint is no longer needed
+        checkpoint.remove()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+    """
+    On-disk cache of LLM responses stored in a SQLite database.
+
+    Responses are keyed by a hash of the model name, system message, prompt,
+    options, output format and a version salt for the prompt template. As all
+    calls are made with temperature 0, a rerun can reuse earlier answers
+    instead of sending the same prompt to the model again. Entries older than max_age_days are
+    removed and the cache is trimmed to max_entries (least recently used
+    first) when it is opened and closed.
+    """
+
+    def __init__(self, path, max_entries=None, max_age_days=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        # The connection is shared between worker threads, so guard it with a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                version TEXT,
+                response TEXT,
+                created REAL,
+                accessed REAL
+            )
+            """
+        )
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model_name, system_message, prompt, options=None, version='', format=None):
+        """
+        Function to build the cache key for a single chat request.
+        """
+        request = {
+            "model": model_name,
+            "system": system_message,
+            "prompt": prompt,
+            "options": options or {},
+            "version": version,
+        }
+        # Only part of the key when set, so keys of unconstrained requests are unchanged
+        if format is not None:
+            request["format"] = format
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Function to look up a cached response. Returns None on a miss.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model_name, version, response):
+        """
+        Function to store a response in the cache.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, version, response, now, now),
+            )
+            self._conn.commit()
+
+    def evict(self):
+        """
+        Function to remove expired entries and trim the cache to max_entries.
+        """
+        with self._lock:
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 86400
+                self._conn.execute("DELETE FROM responses WHERE created < ?", (cutoff,))
+            if self.max_entries is not None:
+                self._conn.execute(
+                    """
+                    DELETE FROM responses WHERE key NOT IN (
+                        SELECT key FROM responses ORDER BY accessed DESC LIMIT ?
+                    )
+                    """,
+                    (self.max_entries,),
+                )
+            self._conn.commit()
+
+    def stats(self):
+        """
+        Function to return the hit/miss counters and the number of stored entries.
+        """
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self):
+        """
+        Function to evict old entries and close the database connection.
+        """
+        self.evict()
+        with self._lock:
+            self._conn.close()
@@ -2,12 +2,31 @@ import argparse
 import re
 import pandas as pd
 
+def extract_states(df_appendices):
+    """
+    Function to split the appendix 2 rules into one row per code and state.
+    Each rule has the form "state text (0); state text (1); ...".
+    """
+    states = list()
+    for row in df_appendices.itertuples():
+        # The semicolon between states is missing in a few rules, so split on the state numbers
+        for match in re.finditer(r"(?P<text>.+?)\s*\((?P<state>\d+)\)\s*;?\s*", row.description):
+            states.append({
+                'number': row.number,
+                'code': row.code,
+                'state': int(match.group('state')),
+                'text': match.group('text'),
+                'subject_gen': row.subject_gen,
+            })
+    return pd.DataFrame(states, columns=['number', 'code', 'state', 'text', 'subject_gen'])
+
 def main():
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Process an appendix text file to structured (CSV) data file.")
     parser.add_argument('input_file', help="Path to the input text file")
     parser.add_argument('--quantitative',action='store_true', help='Process quantitative traits')
     parser.add_argument('output_file', help="Path to the output CSV file")
+    parser.add_argument('--states_file', default=None, help="Optional path to a CSV file for the table of states of each code (appendix 2 only)")
     
     # Parse arguments
     args = parser.parse_args()
@@ -99,5 +118,9 @@ def main():
     # Output as a csv file
     df_appendices.to_csv(args.output_file, index=False)
 
+    # Output the states of each qualitative code, used to render single values without the LLM
+    if args.states_file and not args.quantitative:
+        extract_states(df_appendices).to_csv(args.states_file, index=False)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,87 @@
+from collections import namedtuple
+from contextlib import ExitStack, contextmanager
+from scripts import telemetry
+from scripts.backends import make_backend
+from scripts.cascade import open_cascade
+from scripts.checkpoint import Checkpoint
+from scripts.llm_cache import LLMCache
+
+# What a stage needs to send its LLM calls, see open_session
+LLMSession = namedtuple('LLMSession', ['llm_client', 'cache', 'checkpoint', 'cascade'])
+
+
+def open_cache(args):
+    """
+    Function to open the LLM response cache, unless --no_cache is set.
+    """
+    if args.no_cache:
+        return None
+    return LLMCache(args.cache_file, max_entries=args.cache_max_entries, max_age_days=args.cache_max_age_days)
+
+
+def close_cache(cache):
+    """
+    Function to report the cache hit/miss counters and close the cache.
+    """
+    if cache is None:
+        return
+    stats = cache.stats()
+    print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+    cache.close()
+
+
+def open_metrics(args, stage):
+    """
+    Function to start recording the LLM calls of a pipeline stage.
+    """
+    telemetry.configure(args.metrics_file, stage)
+
+
+def close_metrics():
+    """
+    Function to print the performance report and close the metrics file.
+    """
+    telemetry.close()
+
+
+def open_checkpoint(args):
+    """
+    Function to open the checkpoint file for the current output file.
+    """
+    checkpoint_file = args.checkpoint_file or f"{args.output_file}.checkpoint.jsonl"
+    try:
+        checkpoint = Checkpoint(checkpoint_file, resume=args.resume, fresh=args.fresh)
+    except FileExistsError as e:
+        raise SystemExit(str(e))
+    if args.resume:
+        print(f"Resuming from {checkpoint_file}: {len(checkpoint.results)} units already done")
+    return checkpoint
+
+
+@contextmanager
+def open_session(args, stage):
+    """
+    Context manager setting up everything an LLM stage needs: the connection
+    to the model, the metrics of the stage, the response cache, the
+    checkpoint of completed work and the cascade (if --small_model is set).
+    They are closed in reverse order, and the reports printed, even if the
+    run fails. The checkpoint is kept for --resume unless the stage removed
+    it once its output was saved.
+    """
+    with ExitStack() as stack:
+        # Set up connection to the model (ollama on HPC by default)
+        llm_client = make_backend(args)
+        # Record every LLM call for the performance report
+        open_metrics(args, stage)
+        stack.callback(close_metrics)
+        # Open the cache of previous LLM responses
+        cache = open_cache(args)
+        stack.callback(close_cache, cache)
+        # Open the checkpoint of completed work
+        checkpoint = open_checkpoint(args)
+        stack.callback(checkpoint.close)
+        # Answer with the small model first, if one is set
+        cascade = open_cascade(args, llm_client)
+        if cascade is not None:
+            stack.callback(cascade.report)
+        yield LLMSession(llm_client, cache, checkpoint, cascade)
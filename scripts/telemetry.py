@@ -0,0 +1,226 @@
+import argparse
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Fields copied from Ollama chat responses. Durations are in nanoseconds.
+# endpoint and hedged are added by the load balancing backend.
+RESPONSE_FIELDS = [
+    'prompt_eval_count',
+    'eval_count',
+    'prompt_eval_duration',
+    'eval_duration',
+    'load_duration',
+    'total_duration',
+    'endpoint',
+    'hedged',
+]
+
+# Like the logging module, telemetry is configured once per process and
+# every llm_chat call is recorded to the same metrics file
+_lock = threading.Lock()
+_local = threading.local()
+_file = None
+_stage = None
+_records = []
+
+
+def configure(path, stage):
+    """
+    Function to start recording LLM calls for a pipeline stage to a JSON
+    lines metrics file. Records are appended, so several stages can share
+    one file.
+    """
+    global _file, _stage
+    with _lock:
+        _file = open(path, 'a', encoding='utf-8') if path else None
+        _stage = stage
+        _records.clear()
+
+
+@contextmanager
+def call_context(**fields):
+    """
+    Context manager adding fields (e.g. the unit of work or the codes being
+    asked) to every call recorded on this thread inside the block.
+    """
+    previous = getattr(_local, 'context', {})
+    _local.context = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+
+def current(field):
+    """
+    Function to return a field of the call context of this thread, e.g. the unit of work.
+    """
+    return getattr(_local, 'context', {}).get(field)
+
+
+def record(**fields):
+    """
+    Function to record one LLM call, together with the current call context.
+    """
+    if _stage is None:
+        return
+    this_record = {
+        'time': time.time(),
+        'stage': _stage,
+        **getattr(_local, 'context', {}),
+        **fields,
+    }
+    with _lock:
+        _records.append(this_record)
+        if _file is not None:
+            _file.write(json.dumps(this_record, ensure_ascii=False, default=str) + '\n')
+            _file.flush()
+
+
+def close():
+    """
+    Function to print the report for the calls recorded in this run and
+    close the metrics file.
+    """
+    global _file, _stage
+    with _lock:
+        if _stage is not None:
+            print_report(_records)
+        if _file is not None:
+            _file.close()
+        _file = None
+        _stage = None
+
+
+def percentile(values, q):
+    """
+    Function to return the q-th percentile (0-100) of a list of numbers.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * q / 100
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+def summarize(records):
+    """
+    Function to summarize the recorded calls per stage.
+    """
+    summary = {}
+    for stage in dict.fromkeys(r['stage'] for r in records):
+        # Model loads made by the scheduler are counted apart from the calls
+        events = [r for r in records if r['stage'] == stage and r.get('event')]
+        stage_records = [r for r in records if r['stage'] == stage and not r.get('event')]
+        # Only calls that reached the model tell us about inference speed
+        model_calls = [r for r in stage_records if r.get('cache') not in ('hit', 'replay') and not r.get('error')]
+        latencies = [r['wall_time'] for r in model_calls]
+        prompt_tokens = sum(r.get('prompt_eval_count') or 0 for r in model_calls)
+        output_tokens = sum(r.get('eval_count') or 0 for r in model_calls)
+        prompt_seconds = sum(r.get('prompt_eval_duration') or 0 for r in model_calls) / 1e9
+        eval_seconds = sum(r.get('eval_duration') or 0 for r in model_calls) / 1e9
+        load_seconds = [(r.get('load_duration') or 0) / 1e9 for r in model_calls]
+        summary[stage] = {
+            'calls': len(stage_records),
+            'cache_hits': sum(r.get('cache') == 'hit' for r in stage_records),
+            'replays': sum(r.get('cache') == 'replay' for r in stage_records),
+            'repair_calls': sum(bool(r.get('repair')) for r in stage_records),
+            'errors': sum(bool(r.get('error')) for r in stage_records),
+            'wall_seconds': sum(latencies),
+            'p50_latency': percentile(latencies, 50),
+            'p95_latency': percentile(latencies, 95),
+            'prompt_tokens': prompt_tokens,
+            'output_tokens': output_tokens,
+            'prompt_token_share': prompt_tokens / (prompt_tokens + output_tokens) if prompt_tokens + output_tokens else None,
+            'prompt_tokens_per_second': prompt_tokens / prompt_seconds if prompt_seconds else None,
+            'output_tokens_per_second': output_tokens / eval_seconds if eval_seconds else None,
+            'prompt_seconds': prompt_seconds,
+            'eval_seconds': eval_seconds,
+            'load_seconds': sum(load_seconds),
+            'max_load_seconds': max(load_seconds, default=0),
+            'model_loads': sum(r['event'] == 'load' for r in events),
+            'model_load_seconds': sum(r.get('wall_time') or 0 for r in events),
+            'hedged_calls': sum(bool(r.get('hedged')) for r in model_calls),
+            'endpoint_calls': {
+                endpoint: sum(r.get('endpoint') == endpoint for r in model_calls)
+                for endpoint in dict.fromkeys(r['endpoint'] for r in model_calls if r.get('endpoint'))
+            },
+        }
+    return summary
+
+
+def project_seconds(records, calls, prompt_tokens):
+    """
+    Function to project the model time of a run with the given number of
+    calls and prompt tokens from the throughput of earlier recorded calls.
+    Returns None if there are no recorded calls to base it on.
+    """
+    model_calls = [r for r in records if r.get('cache') not in ('hit', 'replay') and not r.get('error') and not r.get('event')]
+    if not model_calls:
+        return None
+    stats = summarize(model_calls)[model_calls[0]['stage']]
+    if not stats['prompt_tokens_per_second'] or not stats['output_tokens_per_second']:
+        # The backend did not report durations, so use the mean latency
+        return calls * stats['wall_seconds'] / len(model_calls)
+    output_tokens_per_call = stats['output_tokens'] / len(model_calls)
+    # Time per call spent outside prompt ingestion and generation, e.g. HTTP and queueing
+    overhead_per_call = max(stats['wall_seconds'] - stats['prompt_seconds'] - stats['eval_seconds'], 0) / len(model_calls)
+    return (
+        prompt_tokens / stats['prompt_tokens_per_second']
+        + calls * output_tokens_per_call / stats['output_tokens_per_second']
+        + calls * overhead_per_call
+    )
+
+
+def print_report(records):
+    """
+    Function to print a performance report of the recorded calls per stage.
+    """
+    def fmt(value, pattern):
+        return 'n/a' if value is None else pattern.format(value)
+
+    for stage, stats in summarize(records).items():
+        print(f"=== {stage} ===")
+        # Replays only happen with --schedule_models
+        replays = f", {stats['replays']} replayed from an earlier pass" if stats['replays'] else ''
+        print(f"  calls: {stats['calls']} ({stats['cache_hits']} cache hits{replays}, {stats['repair_calls']} repairs, {stats['errors']} errors)")
+        print(f"  latency: p50 {fmt(stats['p50_latency'], '{:.2f}s')}, p95 {fmt(stats['p95_latency'], '{:.2f}s')}, total {stats['wall_seconds']:.1f}s")
+        print(f"  tokens: {stats['prompt_tokens']} prompt, {stats['output_tokens']} output (prompt share {fmt(stats['prompt_token_share'], '{:.1%}')})")
+        print(f"  throughput: prompt {fmt(stats['prompt_tokens_per_second'], '{:.1f}')} tok/s, output {fmt(stats['output_tokens_per_second'], '{:.1f}')} tok/s")
+        print(f"  time: {stats['prompt_seconds']:.1f}s prompt ingestion, {stats['eval_seconds']:.1f}s generation, {stats['load_seconds']:.1f}s model loading (max {stats['max_load_seconds']:.1f}s)")
+        if stats['model_loads']:
+            print(f"  model loads: {stats['model_loads']}, {stats['model_load_seconds']:.1f}s outside the calls")
+        if stats['endpoint_calls']:
+            endpoints = ", ".join(f"{endpoint}: {calls}" for endpoint, calls in stats['endpoint_calls'].items())
+            print(f"  endpoints: {endpoints} ({stats['hedged_calls']} hedged)")
+
+
+def read_metrics(paths):
+    """
+    Function to read the records from one or more metrics files.
+    """
+    records = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file_in:
+            for line in file_in:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prints a performance report from LLM call metrics files.")
+    parser.add_argument('metrics_files', nargs='+', help="Path to the JSON lines metrics file(s)")
+    parser.add_argument('--stage', default=None, help="Only report on this stage (script)")
+    args = parser.parse_args()
+    records = read_metrics(args.metrics_files)
+    if args.stage:
+        records = [r for r in records if r['stage'] == args.stage]
+    print_report(records)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 import argparse
 import json
 import logging
-import ollama
+import os
+import re
 import pandas as pd
 import textwrap
-from scripts.utils import llm_chat, check_valid_json
+from scripts.session import open_session
+from scripts.utils import add_llm_args, llm_chat, iter_jobs, RowWriter, estimate_tokens, make_batches, extract_batch, build_json_schema, ExtractionStats, report_plan
+from .measurements import extract_measurements
+from .relevance import batch_paragraph, subject_index
+from .sentence_store import SentenceStore, group_appendix_items
 
 logging.basicConfig(filename='app1_extraction.log', level=logging.ERROR)
 
@@ -12,6 +17,42 @@ SYSTEM_MESSAGE = """
 You are an expert botanist. You can extract and encode data from text to JSON.
 """
 
+# Bump to invalidate cached responses for this prompt template
+PROMPT_VERSION = "app1_extraction-v3"
+
+# The instructions and examples, followed in each prompt by the codes and description
+PROMPT_PREFIX = textwrap.dedent("""
+    You are an expert botanist. You can extract and encode data 
+    from text. You are supplied with the description of a 
+    species ("description") and a list of trait codes with the 
+    trait they measure ("codes").
+    Make a JSON dictionary with one key for each code and the 
+    corresponding value from the description. Do not fabricate 
+    data and ensure the values correspond to the correct code. 
+    If you cannot score a variable, set the value to null. 
+    Your answer must be as complete and accurate as possible. 
+    Ensure your output is strictly in valid JSON format, and do 
+    not include any extra text. Follow the format of the 
+    following examples.
+
+    ### Example 1:
+    codes: [{"code": "stemlength", "description": "Stem length (m)"}, {"code": "stemdiameter", "description": "Stem diameter (cm)"}]
+    description: "Stems clustered, climbing, 3.0 m long, 1.9(0.7–3.2) cm diameter."
+    response: {"stemlength": "3.0 m", "stemdiameter": "1.9(0.7-3.2) cm"}
+
+    ### Example 2:
+    codes: [{"code": "numpin", "description": "Number of pinnae per side of rachis"}, {"code": "pinlength", "description": "Middle pinna length (cm)"}]
+    description: "pinnae 5(5–6) per side of rachis."
+    response: {"numpin": "5(5-6)", "pinlength": null}
+
+    ### Example 3:
+    codes: [{"code": "psraclen", "description": "Pistillate rachilla length, proximalmost one (cm)"}]
+    description: "pistillate rachillae 3.3(1.8–4.5) cm long."
+    response: {"psraclen": "3.3(1.8–4.5) cm"}
+
+    Generate the JSON for the following:
+""")
+
 
 def parse_args():
     """
@@ -22,6 +63,11 @@ def parse_args():
     parser.add_argument('input_file_app1', help="Path to the input text file containing the appendix1")
     parser.add_argument('output_file', help="Path to the output CSV file where the data is saved")
     parser.add_argument('--model_name', default='llama3.3', help="Name of the model to use for the chat completion (default: 'llama3.3')")
+    parser.add_argument('--token_budget', type=int, default=3000, help="Approximate maximum number of tokens per prompt, used to size the code batches (default: 3000)")
+    parser.add_argument('--context_budget', type=int, default=None, help="If set, each prompt only gets the sentences most relevant to its codes (BM25 on the code descriptions) that fit in this many tokens, instead of the whole paragraph (default: whole paragraph)")
+    parser.add_argument('--no_rules', action='store_true', help="If set, all codes are sent to the LLM instead of first reading the measurements with rules")
+    parser.add_argument('--provenance_file', default=None, help="Path to the CSV file recording where each value came from (default: <output_file>_provenance.csv)")
+    add_llm_args(parser)
     return parser.parse_args()
 
 
@@ -36,73 +82,172 @@ def read_inputs(input_file_sentences, input_file_app1):
     return df_sentences, df_app1
 
 
-def main():
-    args = parse_args()
-    # Set up connection to ollama model on HPC
-    ollama_client = ollama.Client(host='http://127.0.0.1:18199')
-    # Read the input files
+def build_prompt(subject_para, batch):
+    """
+    Function to build the prompt for a batch of Appendix I codes.
+    The variable material goes after the fixed PROMPT_PREFIX.
+    """
+    return PROMPT_PREFIX + f"codes: {json.dumps(batch, ensure_ascii=False)}\ndescription: {subject_para}\n"
+
+
+def validate_value(value):
+    """
+    Function to check that an extracted value is null or contains a number.
+    """
+    return value is None or bool(re.search(r'\d', str(value)))
+
+
+def prepare_subject(args, sentence_store, appendix_items, taxon_name, subject):
+    """
+    Function to get the sentences and paragraph of one subject for one
+    taxon, the values the rules can read from it and the batches of
+    remaining Appendix I items to send to the model.
+    """
+    # Sentences with numbers about the current taxon_name and subject, joined together into a paragraph
+    sentences = sentence_store.sentences(taxon_name, subject, digits_only=True)
+    subject_para = sentence_store.paragraph(taxon_name, subject, digits_only=True)
+    appendix_1_subject = appendix_items.get(subject, [])
+    # Without any sentences containing numbers there is nothing to extract
+    if not subject_para.strip():
+        return sentences, subject_para, appendix_1_subject, {}, []
+    # Fill the codes that the rules can read without the LLM
+    measurements = {}
+    if not args.no_rules:
+        measurements = extract_measurements(subject_para, [item['code'] for item in appendix_1_subject])
+    remaining = [item for item in appendix_1_subject if item['code'] not in measurements]
+    # Size the batches so each prompt stays within the token budget
+    fixed_tokens = estimate_tokens(build_prompt(subject_para, []))
+    if args.context_budget is not None:
+        # Trimmed prompts hold at most context_budget tokens of the paragraph
+        fixed_tokens = min(fixed_tokens, estimate_tokens(build_prompt("", [])) + args.context_budget)
+    batches = make_batches(remaining, fixed_tokens, args.token_budget)
+    return sentences, subject_para, appendix_1_subject, measurements, batches
+
+
+def plan_subject(args, sentence_store, appendix_items, taxon_name, subject):
+    """
+    Function to build the prompts that extract_subject would send, without sending them.
+    """
+    sentences, _, _, _, batches = prepare_subject(args, sentence_store, appendix_items, taxon_name, subject)
+    index = subject_index(sentences, args.context_budget)
+    return [build_prompt(batch_paragraph(sentences, batch, 'description', args.context_budget, index), batch) for batch in batches]
+
+
+def extract_subject(llm_client, cache, args, stats, sentence_store, appendix_items, taxon_name, subject, cascade=None):
+    """
+    Function to extract the Appendix I traits of one subject for one taxon.
+    Measurements in the usual "mean(min–max) unit" phrasing are read with
+    rules first. The remaining codes are sent in one prompt, unless they do
+    not fit in the token budget. Subjects with no sentences containing
+    numbers are filled with null without calling the model.
+    Returns the values and the provenance of each value.
+    """
+    sentences, subject_para, appendix_1_subject, measurements, batches = prepare_subject(args, sentence_store, appendix_items, taxon_name, subject)
+    codes = [item['code'] for item in appendix_1_subject]
+    subject_dict = {}
+    provenance = {}
+    if not subject_para.strip():
+        subject_dict = {code: None for code in codes}
+        provenance = {code: {'source': 'no evidence', 'evidence': None} for code in codes}
+    for code, (value, clause) in measurements.items():
+        subject_dict[code] = value
+        provenance[code] = {'source': 'rule', 'evidence': clause}
+
+    # Index the sentences once for all the batches of the subject
+    index = subject_index(sentences, args.context_budget)
+
+    def ask(batch, model_name=args.model_name):
+        # Only the sentences relevant to the batch's codes, if --context_budget is set
+        prompt = build_prompt(batch_paragraph(sentences, batch, 'description', args.context_budget, index), batch)
+        # Constrain the output to a JSON object with exactly the batch's codes
+        schema = build_json_schema([item['code'] for item in batch])
+        return llm_chat(llm_client, model_name, SYSTEM_MESSAGE, prompt, cache=cache, prompt_version=PROMPT_VERSION, format=schema)
+
+    for batch in batches:
+        # Missing or invalid codes are asked again automatically
+        if cascade is not None:
+            llm_values = cascade.extract(ask, batch, validate_value, stats)
+        else:
+            llm_values = extract_batch(ask, batch, validate_value, stats)
+        subject_dict.update(llm_values)
+        for code in llm_values:
+            provenance[code] = {'source': 'llm', 'evidence': None}
+    # Keep the codes in appendix order
+    subject_dict = {code: subject_dict[code] for code in codes if code in subject_dict}
+    return subject_dict, provenance
+
+
+def plan(args):
+    """
+    Function to report the calls a run would make without contacting the server.
+    """
     df_sentences, df_app1 = read_inputs(args.input_file_sentences, args.input_file_app1)
-    # Create an empty dataframe to store the output
-    df_output = pd.DataFrame()
-    # Iterate over each unique species
-    for taxon_name in df_sentences.taxon_name.unique():
-        # Set up dictionary to store species names
-        taxon_dict = {'taxon_name': taxon_name}
-        # Iterate over each subject in appendix_2 dataframe
+    sentence_store = SentenceStore(df_sentences, 'subject_extract')
+    appendix_items = group_appendix_items(df_app1, 'subject_extract', ["code", "description"])
+    prompts = []
+    skipped = 0
+    for taxon_name in sentence_store.taxon_names:
         for subject in df_app1.subject_extract.unique():
-            mask = (
-                (df_sentences.subject_extract == subject) &
-                (df_sentences.taxon_name == taxon_name) &
-                (df_sentences.sentence.str.contains("[0-9]"))
-            )
-            # Sentences about the current taxon_name and subject are joined together into a paragraph
-            subject_para = " ".join(
-                df_sentences[mask]['sentence'].to_list()
-            )
-            appendix_1_subject = df_app1[
-                df_app1.subject_extract == subject
-            ][["description", "code"]]
-            for _, row in appendix_1_subject.iterrows():
-                prompt = textwrap.dedent(f"""
-                    You are an expert botanist. You can extract and encode data 
-                    from text. You are supplied with the description of a 
-                    species ("description"), a code for a trait ("code").
-                    Make a JSON dictionary with the key code and the 
-                    corresponding value from the description. Do not fabricate 
-                    data and ensure the values correspond to the correct code. 
-                    If you cannot score the variable, set the value to null. 
-                    Your answer must be as complete and accurate as possible. 
-                    Ensure your output is strictly in valid JSON format, and do 
-                    not include any extra text. Follow the format of the 
-                    following examples.
-
-                    ### Example 1:
-                    description: "Stems clustered, climbing, 3.0 m long."
-                    code: "stemlength"
-                    response: {{"stemlength": "3.0 m"}}
-
-                    ### Example 2:
-                    description: "pinnae 5(5–6) per side of rachis."
-                    code: "numpin"
-                    response: {{"numpin": "5(5-6)"}}
-
-                    ### Example 3:
-                    description: "pistillate rachillae 3.3(1.8–4.5) cm long."
-                    code: "psraclen"
-                    response: {{"psraclen": "3.3(1.8–4.5) cm"}}
-
-                    Generate the JSON for the following:\n
-                    description: {subject_para}\n
-                    code: {row['code']}
-                """)
-                output = llm_chat(ollama_client, args.model_name, SYSTEM_MESSAGE, prompt)
-                # Check if the output is a valid JSON object
-                taxon_dict = check_valid_json(output, taxon_dict)
-        # Convert taxon_dict into a pandas dataframe and join it to the output
-        df_taxon = pd.DataFrame([taxon_dict])
-        df_output = pd.concat([df_output, df_taxon])
-    # Save the output to a CSV file
-    df_output.to_csv(args.output_file, index=False)
+            subject_prompts = plan_subject(args, sentence_store, appendix_items, taxon_name, subject)
+            skipped += not subject_prompts
+            prompts.extend(subject_prompts)
+    report_plan(args, 'app1_extraction', SYSTEM_MESSAGE, prompts, skipped)
+
+
+def main():
+    args = parse_args()
+    if args.plan:
+        plan(args)
+        return
+    # Set up the model, cache, metrics, checkpoint and cascade, closed even if the run fails
+    with open_session(args, 'app1_extraction') as (llm_client, cache, checkpoint, cascade):
+        # Count invalid outputs and repair calls
+        stats = ExtractionStats()
+        # Read the input files
+        df_sentences, df_app1 = read_inputs(args.input_file_sentences, args.input_file_app1)
+        # Group the sentences and appendix items once, so each unit is a lookup
+        sentence_store = SentenceStore(df_sentences, 'subject_extract')
+        appendix_items = group_appendix_items(df_app1, 'subject_extract', ["code", "description"])
+        taxon_names = sentence_store.taxon_names
+        subjects = df_app1.subject_extract.unique()
+        # Each taxon and subject pair is an independent unit of work, so the
+        # units can be sent to the model concurrently
+        units = [(taxon_name, subject) for taxon_name in taxon_names for subject in subjects]
+        # The results arrive in unit order, taxon by taxon
+        results = iter_jobs(
+            lambda unit: extract_subject(llm_client, cache, args, stats, sentence_store, appendix_items, *unit, cascade=cascade),
+            units,
+            args.concurrency,
+            checkpoint,
+            cascade,
+        )
+        # One column per Appendix I code, whether or not a value was found
+        columns = ['taxon_name'] + list(dict.fromkeys(item['code'] for subject in subjects for item in appendix_items.get(subject, [])))
+        writer = RowWriter(f"{args.output_file}.rows.jsonl", columns)
+        # Record where each value came from
+        provenance_file = args.provenance_file or f"{os.path.splitext(args.output_file)[0]}_provenance.csv"
+        provenance_writer = RowWriter(f"{provenance_file}.rows.jsonl", ['taxon_name', 'code', 'value', 'source', 'evidence'])
+        rule_values = 0
+        # Iterate over each unique species
+        for taxon_name in taxon_names:
+            # Set up dictionary to store species names
+            taxon_dict = {'taxon_name': taxon_name}
+            # Merge the subjects in their original order
+            for subject in subjects:
+                subject_dict, provenance = next(results)
+                taxon_dict.update(subject_dict)
+                for code, value in subject_dict.items():
+                    provenance_writer.write({'taxon_name': taxon_name, 'code': code, 'value': value, **provenance[code]})
+                    rule_values += provenance[code]['source'] == 'rule'
+            # Write the taxon as soon as all its subjects are done
+            writer.write(taxon_dict)
+        # Save the output and the provenance of each value to CSV files
+        writer.to_csv(args.output_file)
+        provenance_writer.to_csv(provenance_file)
+        print(f"{rule_values} of {provenance_writer.rows} values read with rules, {provenance_writer.rows - rule_values} from the LLM")
+        # The output is saved, so the checkpoint is no longer needed
+        checkpoint.remove()
+        stats.report()
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,12 @@
 import argparse
-import json
 import logging
-import ollama
+import re
 import pandas as pd
-from scripts.utils import llm_chat, check_valid_json
+from scripts.session import open_session
+from scripts.utils import add_llm_args, llm_chat, iter_jobs, RowWriter, estimate_tokens, make_batches, extract_batch, build_json_schema, ExtractionStats, report_plan
 from .prompts import *
+from .relevance import batch_paragraph, subject_index
+from .sentence_store import SentenceStore, group_appendix_items
 
 logging.basicConfig(filename='app2_extraction.log', level=logging.ERROR)
 
@@ -49,59 +51,164 @@ def parse_args():
                     ))   
     parser.add_argument('output_file', help="Path to the output CSV file where the data is saved")
     parser.add_argument('--model_name', default='llama3.3', help="Name of the model to use for the chat completion (default: 'llama3.3')")
+    parser.add_argument('--token_budget', type=int, default=3000, help="Approximate maximum number of tokens per prompt, used to size the code batches (default: 3000)")
+    parser.add_argument('--context_budget', type=int, default=None, help="If set, each prompt only gets the sentences most relevant to its codes (BM25 on the code rules) that fit in this many tokens, instead of the whole paragraph (default: whole paragraph)")
+    add_llm_args(parser)
     return parser.parse_args()
 
 
+def validate_value(value):
+    """
+    Function to check that a score is null or one or more rule numbers, e.g. "0,1".
+    """
+    return value is None or bool(re.fullmatch(r'\s*\d+(\s*,\s*\d+)*\s*', str(value)))
+
+
+def get_prompt_outline(prompt_style):
+    """
+    Function to get the prompt template for a prompt style.
+    """
+    if prompt_style == 'zeroshot':
+        return ZERO_SHOT_PROMPT
+    elif prompt_style == 'fewshot':
+        return FEW_SHOT_PROMPT
+    elif prompt_style == 'cot':
+        return COT_PROMPT
+    elif prompt_style == 'cot-fewshot':
+        return COT_FEWSHOT_PROMPT
+
+
+def prepare_subject(args, sentence_store, appendix_items, taxon_name, subject):
+    """
+    Function to get the sentences, the paragraph, the Appendix II items and
+    the batches of items to send to the model for one subject of one taxon.
+    """
+    # Sentences about the current taxon_name and subject, joined together into a paragraph
+    sentences = sentence_store.sentences(taxon_name, subject)
+    subject_para = sentence_store.paragraph(taxon_name, subject)
+    # The 'code' and 'rules' of the Appendix II items of the current subject
+    appendix_2_subject = appendix_items.get(subject, [])
+    # Without any sentences there is nothing to score, so no batches are needed
+    if not subject_para.strip():
+        return sentences, subject_para, appendix_2_subject, []
+    # Size the batches so each prompt stays within the token budget, rather than using a fixed batch size
+    prompt_outline = get_prompt_outline(args.prompt_style)
+    fixed_tokens = estimate_tokens(prompt_outline.format(subject_para=subject_para, appendix_2_subject_batch=[]))
+    if args.context_budget is not None:
+        # Trimmed prompts hold at most context_budget tokens of the paragraph
+        fixed_tokens = min(fixed_tokens, estimate_tokens(prompt_outline.format(subject_para="", appendix_2_subject_batch=[])) + args.context_budget)
+    batches = make_batches(appendix_2_subject, fixed_tokens, args.token_budget)
+    return sentences, subject_para, appendix_2_subject, batches
+
+
+def plan_subject(args, sentence_store, appendix_items, taxon_name, subject):
+    """
+    Function to build the prompts that extract_subject would send, without sending them.
+    """
+    sentences, _, _, batches = prepare_subject(args, sentence_store, appendix_items, taxon_name, subject)
+    prompt_outline = get_prompt_outline(args.prompt_style)
+    index = subject_index(sentences, args.context_budget)
+    return [
+        prompt_outline.format(subject_para=batch_paragraph(sentences, batch, 'rules', args.context_budget, index), appendix_2_subject_batch=batch)
+        for batch in batches
+    ]
+
+
+def extract_subject(llm_client, cache, args, stats, sentence_store, appendix_items, taxon_name, subject, cascade=None):
+    """
+    Function to extract the Appendix II traits of one subject for one taxon.
+    Subjects with no sentences are filled with null without calling the model.
+    """
+    sentences, _, appendix_2_subject, batches = prepare_subject(args, sentence_store, appendix_items, taxon_name, subject)
+    subject_dict = {item['code']: None for item in appendix_2_subject}
+    prompt_outline = get_prompt_outline(args.prompt_style)
+    # Index the sentences once for all the batches of the subject
+    index = subject_index(sentences, args.context_budget)
+
+    def ask(batch, model_name=args.model_name):
+        logging.debug(f"this is a batch: {batch}")
+        # Only the sentences relevant to the batch's codes, if --context_budget is set
+        subject_para = batch_paragraph(sentences, batch, 'rules', args.context_budget, index)
+        prompt = prompt_outline.format(subject_para=subject_para, appendix_2_subject_batch=batch)
+        # Constrain the output to a JSON object with exactly the batch's codes.
+        # The chain-of-thought styles need free text for their reasoning, so
+        # their JSON is picked out of the answer instead
+        schema = None
+        if args.prompt_style in ('zeroshot', 'fewshot'):
+            schema = build_json_schema([item['code'] for item in batch])
+        return llm_chat(llm_client, model_name, SYSTEM_MESSAGE, prompt, cache=cache, prompt_version=PROMPT_VERSIONS[args.prompt_style], format=schema)
+
+    for batch in batches:
+        # Missing or invalid codes are asked again automatically
+        if cascade is not None:
+            subject_dict.update(cascade.extract(ask, batch, validate_value, stats))
+        else:
+            subject_dict.update(extract_batch(ask, batch, validate_value, stats))
+    return subject_dict
+
+
+def plan(args):
+    """
+    Function to report the calls a run would make without contacting the server.
+    """
+    df_sentences, df_app2 = read_input_files(args.input_file_sentences, args.input_file_app2)
+    sentence_store = SentenceStore(df_sentences, 'subject')
+    appendix_items = group_appendix_items(df_app2, 'subject', ["code", "rules"])
+    prompts = []
+    skipped = 0
+    for taxon_name in sentence_store.taxon_names:
+        for subject in df_app2.subject.unique():
+            subject_prompts = plan_subject(args, sentence_store, appendix_items, taxon_name, subject)
+            skipped += not subject_prompts
+            prompts.extend(subject_prompts)
+    report_plan(args, 'app2_extraction', SYSTEM_MESSAGE, prompts, skipped)
+
+
 def main():
     # Parse arguments
     args = parse_args()
-    # Set up connection to ollama model on HPC
-    ollama_client = ollama.Client(host='http://127.0.0.1:18199')
-    # Read in the input files
-    df_sentences, df_app2 = read_input_files(args.input_file_sentences, args.input_file_app2)
-    # Create an empty dataframe to store the output
-    df_output = pd.DataFrame()
-    # Iterate over each unique taxon_name
-    for taxon_name in df_sentences.taxon_name.unique():
-        # Set up dictionary to store species names
-        taxon_dict = {'taxon_name': taxon_name}
-        # Iterate over each subject in appendix_2 dataframe
-        for subject in df_app2.subject.unique():
-            mask = (
-                (df_sentences.subject == subject) &
-                (df_sentences.taxon_name == taxon_name)
-            )
-            # Sentences about the current taxon_name and subject are joined together into a paragraph
-            subject_para = " ".join(
-                df_sentences[mask]['sentence'].to_list()
-            )
-            # Batch size
-            batch_size = 8
-            # Filter df_app2 to get rows matching current subject and code, selecting only the 'code' and 'rules' columns
-            df_app2_subject = df_app2[df_app2.subject == subject][["code", "rules"]]
-            # Split the DataFrame into batches of length batch_size using list comprehension
-            batches = [df_app2_subject[i:i + batch_size] for i in range(0, len(df_app2_subject), batch_size)]
-            # Iterate through each batch and convert to json
-            for batch in batches: 
-                print(f"this is a batch: {batch}")
-                appendix_2_subject_batch = json.loads(batch.to_json(orient="records"))
-                if args.prompt_style == 'zeroshot':
-                    prompt_outline = ZERO_SHOT_PROMPT
-                elif args.prompt_style == 'fewshot':
-                    prompt_outline = FEW_SHOT_PROMPT
-                elif args.prompt_style == 'cot':
-                    prompt_outline = COT_PROMPT
-                elif args.prompt_style == 'cot-fewshot':
-                    prompt_outline = COT_FEWSHOT_PROMPT
-                prompt = prompt_outline.format(subject_para=subject_para, appendix_2_subject_batch=appendix_2_subject_batch)
-                output = llm_chat(ollama_client, args.model_name, SYSTEM_MESSAGE, prompt)
-                # Check if the output is a valid JSON object
-                taxon_dict = check_valid_json(output, taxon_dict)
-        # Convert taxon_dict into a pandas dataframe and join it to the output
-        df_taxon = pd.DataFrame([taxon_dict])
-        df_output = pd.concat([df_output, df_taxon])
-    # Save the output to a CSV file
-    df_output.to_csv(args.output_file, index=False)
+    if args.plan:
+        plan(args)
+        return
+    # Set up the model, cache, metrics, checkpoint and cascade, closed even if the run fails
+    with open_session(args, 'app2_extraction') as (llm_client, cache, checkpoint, cascade):
+        # Count invalid outputs and repair calls
+        stats = ExtractionStats()
+        # Read in the input files
+        df_sentences, df_app2 = read_input_files(args.input_file_sentences, args.input_file_app2)
+        # Group the sentences and appendix items once, so each unit is a lookup
+        sentence_store = SentenceStore(df_sentences, 'subject')
+        appendix_items = group_appendix_items(df_app2, 'subject', ["code", "rules"])
+        taxon_names = sentence_store.taxon_names
+        subjects = df_app2.subject.unique()
+        # Each taxon and subject pair is an independent unit of work, so the
+        # units can be sent to the model concurrently
+        units = [(taxon_name, subject) for taxon_name in taxon_names for subject in subjects]
+        # The results arrive in unit order, taxon by taxon
+        results = iter_jobs(
+            lambda unit: extract_subject(llm_client, cache, args, stats, sentence_store, appendix_items, *unit, cascade=cascade),
+            units,
+            args.concurrency,
+            checkpoint,
+            cascade,
+        )
+        # One column per Appendix II code, whether or not a value was found
+        columns = ['taxon_name'] + list(dict.fromkeys(item['code'] for subject in subjects for item in appendix_items.get(subject, [])))
+        writer = RowWriter(f"{args.output_file}.rows.jsonl", columns)
+        # Iterate over each unique taxon_name
+        for taxon_name in taxon_names:
+            # Set up dictionary to store species names
+            taxon_dict = {'taxon_name': taxon_name}
+            # Merge the subjects in their original order
+            for subject in subjects:
+                taxon_dict.update(next(results))
+            # Write the taxon as soon as all its subjects are done
+            writer.write(taxon_dict)
+        # Save the output to a CSV file
+        writer.to_csv(args.output_file)
+        # The output is saved, so the checkpoint is no longer needed
+        checkpoint.remove()
+        stats.report()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,77 @@
+import re
+
+# A measurement in the monograph's "mean(min–max)" format, e.g. "3.3(1.8–4.5)"
+# or a single value, e.g. "3.0". It must not continue a number or a plain
+# range, so "1–2 cm" or "1.2-1.5 cm" are left to the LLM rather than read as
+# "2 cm" or "1.5 cm".
+MEASUREMENT = r"(?<![\d.–-])\d+(?:\.\d+)?(?:\(\d+(?:\.\d+)?[–-]\d+(?:\.\d+)?\))?"
+
+# For each Appendix I code: the structure the clause must start with and
+# the words that follow the measurement. The unit (if any) sits between
+# the two, e.g. "pistillate rachillae 3.3(1.8–4.5) cm long".
+# Codes that are not listed here (e.g. apjoin) are always sent to the LLM.
+MEASUREMENT_RULES = {
+    'stemlength': (r"stems?", r"m long"),
+    'stemdiameter': (r"stems?", r"(?:mm|cm) diameter"),
+    'petiole': (r"petioles?", r"(?:mm|cm|m) long"),
+    'rachislen': (r"rachis(?:es)?", r"(?:cm|m) long"),
+    'numpin': (r"pinnae", r"per side of rachis"),
+    'pinlength': (r"middle pinnae", r"(?:mm|cm) long"),
+    'pinwidth': (r"middle pinnae", r"(?:mm|cm) wide"),
+    'stinflolen': (r"staminate inflorescences?", r"(?:cm|m) long"),
+    'straclen': (r"staminate rachillae", r"(?:mm|cm) long"),
+    'pisinflolen': (r"pistillate inflorescences?", r"(?:cm|m) long"),
+    'psraclen': (r"pistillate rachillae", r"(?:mm|cm) long"),
+    'fruitlen': (r"fruits?", r"(?:mm|cm) long"),
+    'fruitdiam': (r"fruits?", r"(?:mm|cm) diameter"),
+}
+
+
+def split_clauses(text):
+    """
+    Function to split a description into clauses. Treatments separate the
+    structures of a paragraph with semicolons and full stops.
+    """
+    # Markdown bold markers may be left around the structure names
+    text = text.replace('**', '')
+    return [clause.strip() for clause in re.split(r";|\.(?=\s|$)", text) if clause.strip()]
+
+
+def format_measurement(measurement, unit):
+    """
+    Function to format a measurement like the LLM examples, e.g. "1.9(0.7-3.2) cm".
+    """
+    measurement = measurement.replace('–', '-')
+    return f"{measurement} {unit}" if unit else measurement
+
+
+def extract_measurements(text, codes):
+    """
+    Function to extract the Appendix I measurements that can be read from
+    the description without the LLM. A code is only filled when exactly one
+    clause starting with its structure gives exactly one matching value.
+    Returns a dict of code to (value, clause) for the codes it could fill.
+    """
+    clauses = split_clauses(text)
+    found = {}
+    for code in codes:
+        if code not in MEASUREMENT_RULES:
+            continue
+        structure, dimension = MEASUREMENT_RULES[code]
+        pattern = rf"(?P<measurement>{MEASUREMENT})\s*(?P<dimension>{dimension})\b"
+        matches = []
+        for clause in clauses:
+            if not re.match(rf"{structure}\b", clause, flags=re.IGNORECASE):
+                continue
+            for match in re.finditer(pattern, clause):
+                # "to 15 m long" is an upper bound, not a measurement
+                if re.search(r"\bto\s*$", clause[:match.start()], flags=re.IGNORECASE):
+                    continue
+                # The unit is the first word of the dimension, if it has one
+                words = match.group('dimension').split()
+                unit = words[0] if words[0] in ('mm', 'cm', 'm') else ''
+                matches.append((format_measurement(match.group('measurement'), unit), clause))
+        # Leave ambiguous or missing values to the LLM
+        if len({value for value, _ in matches}) == 1:
+            found[code] = matches[0]
+    return found
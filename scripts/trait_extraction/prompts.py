@@ -1,17 +1,32 @@
 from textwrap import dedent
 
+# Every prompt of the pipeline, here and in the description scripts, starts
+# with the instructions and examples, which are the same for every call, and
+# ends with the material of the call (e.g. the rules and description). This
+# keeps a byte-identical prefix that the server can reuse from its prompt
+# cache. tests/test_prompts.py checks the order.
+
+# Version salt for each prompt template, bump to invalidate cached responses
+PROMPT_VERSIONS = {
+    'zeroshot': "zeroshot-v2",
+    'fewshot': "fewshot-v2",
+    'cot': "cot-v2",
+    'cot-fewshot': "cot-fewshot-v2",
+}
+
 ZERO_SHOT_PROMPT = dedent(f"""
     ### Task ###
     Create a JSON object where the key is the "code" and its corresponding value is a numeric score derived by applying the given rules to the respective descriptions. 
     Ensure the JSON object includes all specified codes, with scores accurately matching their respective codes. 
     If a score cannot be determined for a code, assign a value of null. 
     Provide a complete and accurate JSON object without any extra text or fabricated data, and export it as a JSON object with no whitespace or trailing commas.
-                        
+
+    Carefully analyse the description and apply the rules systematically before generating the JSON response.
+
     ### Materials ###
-    A description of a species: {{subject_para}}\n
     A JSON dictionary of trait codes ("code") and sets of rules ("rules") for encoding trait values:\n
     {{appendix_2_subject_batch}}
-    Carefully analyse the description and apply the rules systematically before generating the JSON response.
+    A description of a species: {{subject_para}}
 """)
 
 FEW_SHOT_PROMPT = dedent(f"""
@@ -21,12 +36,6 @@ FEW_SHOT_PROMPT = dedent(f"""
     If a score cannot be determined for a code, assign a value of null. 
     Provide a complete and accurate JSON object without any extra text or fabricated data, and export it as a JSON object with no whitespace or trailing commas.
 
-    ### Materials ###
-    A description of a species: {{subject_para}}\n
-    A JSON dictionary of trait codes ("code") and sets of rules ("rules") for encoding trait values:\n
-    {{appendix_2_subject_batch}}
-    Carefully analyse the description and apply the rules systematically before generating the JSON response.
-    
     #### Example 1 ###
     description: "rachises 36.2(28.5–45.0) cm long, the  apices extended into an elongate cirrus, without reduced or vestigial pinnae, adaxially flat, abaxially with more or  less regularly arranged (at least proximally), distantly spaced clusters of dark–tipped, recurved spines, terminating  in a stub, without a shallow groove adaxially"
     rules: "Petioles and rachises with long, straight, yellowish or brownish, black-tipped, usually solitary spines abaxially and laterally (0); petioles and rachises without long, straight, spines abaxially and laterally (1)"
@@ -56,25 +65,35 @@ FEW_SHOT_PROMPT = dedent(f"""
     rules: "Stems solitary (0); stems clustered (1)"
     code: "solclu"
     This description applied to multiple rules, therefore assign both rules. output: "{{{{"solclu": "0,1"}}}}"
+
+    Carefully analyse the description and apply the rules systematically before generating the JSON response.
+
+    ### Materials ###
+    A JSON dictionary of trait codes ("code") and sets of rules ("rules") for encoding trait values:\n
+    {{appendix_2_subject_batch}}
+    A description of a species: {{subject_para}}
 """)
 
 COT_PROMPT = dedent(f"""
-    1. List the questions that you would ask to score a plant according to the "rules" in this rubric. Ensure that each question is atomic and concerns only a single character (shape, structure, etc):\n
-    {{appendix_2_subject_batch}}
-    2. Now apply those questions to this description:\n
-    {{subject_para}}
+    ### Instructions ###
+    1. List the questions that you would ask to score a plant according to the "rules" in the rubric below. Ensure that each question is atomic and concerns only a single character (shape, structure, etc).
+    2. Now apply those questions to the description below.
     3. Now combine the answers to give me a rubric score. If you cannot give a score, set the value to null.
     4. Export the answers as a JSON object. Use the code as the key. Ensure no white space or trailing commas.
+
+    ### Rubric ###
+    {{appendix_2_subject_batch}}
+
+    ### Description ###
+    {{subject_para}}
 """)
 
 COT_FEWSHOT_PROMPT = dedent(f"""
     ### Instructions ###
-    1. list the questions that you would ask to score a plant according to the "rules" in this rubric. Ensure that each question is atomic and concerns only a single character (shape, structure etc):\n
-    {{appendix_2_subject_batch}}
-    2. Now apply those questions to this description:\n
-    {{subject_para}}
-    3. Now combine the answers to give me a rubric score. If you cannot give a score, set the value to null. 
-    4. Export the answers as a JSON object. Use the code as the key. Ensure no white space or trailing commas. 
+    1. List the questions that you would ask to score a plant according to the "rules" in the rubric below. Ensure that each question is atomic and concerns only a single character (shape, structure, etc).
+    2. Now apply those questions to the description below.
+    3. Now combine the answers to give me a rubric score. If you cannot give a score, set the value to null.
+    4. Export the answers as a JSON object. Use the code as the key. Ensure no white space or trailing commas.
 
     #### Example 1 ###
     description: "rachises 36.2(28.5–45.0) cm long, the  apices extended into an elongate cirrus, without reduced or vestigial pinnae, adaxially flat, abaxially with more or  less regularly arranged (at least proximally), distantly spaced clusters of dark–tipped, recurved spines, terminating  in a stub, without a shallow groove adaxially"
@@ -105,4 +124,10 @@ COT_FEWSHOT_PROMPT = dedent(f"""
     rules: "Stems solitary (0); stems clustered (1)"
     code: "solclu"
     This description applied to multiple rules, therefore assign both rules. output: "{{{{"solclu": "0,1"}}}}"
-""")
\ No newline at end of file
+
+    ### Rubric ###
+    {{appendix_2_subject_batch}}
+
+    ### Description ###
+    {{subject_para}}
+""")
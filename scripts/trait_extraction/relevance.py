@@ -0,0 +1,110 @@
+import math
+import re
+from collections import Counter
+from scripts.utils import estimate_tokens
+
+# Words that say nothing about which trait a sentence describes
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'of', 'on', 'or', 'the', 'to', 'with', 'without', 'not', 'above',
+}
+
+
+def tokenize(text):
+    """
+    Function to split text into lower case word stems for matching, e.g.
+    "Pinnae regularly arranged" gives ["pinna", "regularly", "arranged"].
+    """
+    tokens = []
+    for word in re.findall(r"[a-z]+", str(text).lower()):
+        if word in STOPWORDS or len(word) < 3:
+            continue
+        # Treat singular and plural forms alike (sheath/sheaths, pinna/pinnae)
+        word = re.sub(r"(?<=.{3})(?:es|e|s)$", "", word)
+        tokens.append(word)
+    return tokens
+
+
+class BM25:
+    """
+    BM25 index over the sentences of one paragraph, so the sentences most
+    relevant to a batch of codes can be picked without any model.
+    """
+
+    def __init__(self, sentences, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = [Counter(tokenize(sentence)) for sentence in sentences]
+        self.lengths = [sum(document.values()) for document in self.documents]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        document_frequency = Counter(token for document in self.documents for token in document)
+        num_documents = len(self.documents)
+        self.idf = {
+            token: math.log(1 + (num_documents - frequency + 0.5) / (frequency + 0.5))
+            for token, frequency in document_frequency.items()
+        }
+
+    def scores(self, query):
+        """
+        Function to score every sentence against a query text.
+        """
+        query_tokens = set(tokenize(query))
+        scores = []
+        for document, length in zip(self.documents, self.lengths):
+            score = 0.0
+            for token in query_tokens & document.keys():
+                frequency = document[token]
+                norm = self.k1 * (1 - self.b + self.b * length / (self.average_length or 1))
+                score += self.idf[token] * frequency * (self.k1 + 1) / (frequency + norm)
+            scores.append(score)
+        return scores
+
+
+def trim_paragraph(sentences, query, token_budget, index=None):
+    """
+    Function to keep the sentences most relevant to the query that fit in
+    token_budget, joined in their original order. Sentences that share no
+    word with the query are only kept while there is room left. The best
+    sentence is always kept, even when it is longer than the budget.
+    """
+    if not sentences:
+        return ""
+    if estimate_tokens(" ".join(sentences)) <= token_budget:
+        return " ".join(sentences)
+    index = index or BM25(sentences)
+    scores = index.scores(query)
+    # Most relevant first; ties keep the original order
+    ranked = sorted(range(len(sentences)), key=lambda i: -scores[i])
+    kept = []
+    used = 0
+    for i in ranked:
+        tokens = estimate_tokens(sentences[i]) + 1
+        if kept and used + tokens > token_budget:
+            continue
+        kept.append(i)
+        used += tokens
+    return " ".join(sentences[i] for i in sorted(kept))
+
+
+def subject_index(sentences, token_budget=None):
+    """
+    Function to build the BM25 index of a subject's sentences once, to be
+    shared by all its batches. None when there is no token_budget, as the
+    whole paragraph is then sent.
+    """
+    if token_budget is None or not sentences:
+        return None
+    return BM25(sentences)
+
+
+def batch_paragraph(sentences, batch, field, token_budget=None, index=None):
+    """
+    Function to get the paragraph to send with a batch of appendix items.
+    With a token_budget, only the sentences most relevant to the items'
+    field (the description or the rules) are kept, using the subject's
+    index from subject_index. Without one, the whole paragraph is sent.
+    """
+    if token_budget is None:
+        return " ".join(sentences)
+    query = " ".join(str(item[field]) for item in batch)
+    return trim_paragraph(sentences, query, token_budget, index)
@@ -0,0 +1,51 @@
+import json
+import re
+
+
+class SentenceStore:
+    """
+    The sentences of every taxon, grouped by (taxon_name, subject) once so
+    the extraction loops can look up a subject's sentences and paragraph
+    without scanning the whole sentence table. Sentences keep their order
+    in the table. Sentences containing a digit are also kept apart, as only
+    those can hold the measurements of Appendix I.
+    """
+
+    def __init__(self, df_sentences, subject_column):
+        self._sentences = {}
+        self._digit_sentences = {}
+        for taxon_name, subject, sentence in zip(df_sentences.taxon_name, df_sentences[subject_column], df_sentences.sentence):
+            key = (taxon_name, subject)
+            self._sentences.setdefault(key, []).append(sentence)
+            if isinstance(sentence, str) and re.search(r"[0-9]", sentence):
+                self._digit_sentences.setdefault(key, []).append(sentence)
+        # Join the paragraphs up front, as every batch of a subject needs them
+        self._paragraphs = {key: " ".join(sentences) for key, sentences in self._sentences.items()}
+        self._digit_paragraphs = {key: " ".join(sentences) for key, sentences in self._digit_sentences.items()}
+        self.taxon_names = list(dict.fromkeys(df_sentences.taxon_name))
+
+    def sentences(self, taxon_name, subject, digits_only=False):
+        """
+        Function to get the sentences about a subject of a taxon, optionally
+        only those containing a digit.
+        """
+        store = self._digit_sentences if digits_only else self._sentences
+        return store.get((taxon_name, subject), [])
+
+    def paragraph(self, taxon_name, subject, digits_only=False):
+        """
+        Function to get the sentences about a subject of a taxon joined into a paragraph.
+        """
+        store = self._digit_paragraphs if digits_only else self._paragraphs
+        return store.get((taxon_name, subject), "")
+
+
+def group_appendix_items(df_appendix, subject_column, columns):
+    """
+    Function to get the appendix items (dicts of the given columns) of every
+    subject, in appendix order.
+    """
+    items = {}
+    for subject in df_appendix[subject_column].unique():
+        items[subject] = json.loads(df_appendix[df_appendix[subject_column] == subject][columns].to_json(orient="records"))
+    return items
@@ -1,31 +1,302 @@
 import json
 import logging
+import math
+import os
+import re
+import threading
+import time
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from scripts import telemetry
+from scripts.backends import ModelDeferred, add_backend_args
 
 
-def llm_chat(ollama_client, model_name,system_mesage, prompt):
+def add_llm_args(parser):
     """
-    Function to generate a description using the Ollama model.
+    Function to add the command line arguments shared by the LLM scripts.
     """
-    chat_completion = ollama_client.chat(
+    add_backend_args(parser)
+    parser.add_argument('--cache_file', default='llm_cache.sqlite', help="Path to the SQLite file used to cache LLM responses (default: 'llm_cache.sqlite')")
+    parser.add_argument('--no_cache', action='store_true', help="If set, every prompt is sent to the model and no responses are cached.")
+    parser.add_argument('--cache_max_entries', type=int, default=200000, help="Maximum number of responses kept in the cache (default: 200000)")
+    parser.add_argument('--cache_max_age_days', type=float, default=90, help="Cached responses older than this are discarded (default: 90)")
+    parser.add_argument('--concurrency', type=int, default=1, help="Maximum number of LLM requests in flight at once (default: 1)")
+    parser.add_argument('--checkpoint_file', default=None, help="Path to the checkpoint file of completed work (default: the output file with '.checkpoint.jsonl' appended)")
+    parser.add_argument('--resume', action='store_true', help="If set, work already recorded in the checkpoint file is skipped.")
+    parser.add_argument('--fresh', action='store_true', help="If set, an existing checkpoint file is discarded and the run starts over. Without --resume or --fresh, a run refuses to overwrite a checkpoint.")
+    parser.add_argument('--metrics_file', default='llm_metrics.jsonl', help="Path to the JSON lines file where every LLM call is recorded, '' to disable (default: 'llm_metrics.jsonl')")
+    parser.add_argument('--small_model', default=None, help="If set, each call is first answered by this smaller, faster model and only escalated to --model_name when the answer fails validation (default: no cascade)")
+    parser.add_argument('--hard_codes', default='', help="Comma-separated list of codes (or subjects) that always go straight to --model_name when --small_model is set")
+    parser.add_argument('--schedule_models', action='store_true', help="If set with --small_model and the ollama backend, every job is first run with the small model only, and the jobs that need --model_name are run again in a second pass with that model, so the models are loaded once per pass instead of once per escalation.")
+    parser.add_argument('--plan', action='store_true', help="If set, nothing is sent to the model. The number of calls, estimated prompt tokens and projected wall time (from the throughput recorded in --metrics_file) are printed instead.")
+    return parser
+
+
+def report_plan(args, stage, system_message, prompts, skipped=0):
+    """
+    Function to print the plan of a run: the number of LLM calls, the
+    estimated prompt tokens and the wall time projected from the calls
+    recorded for the same stage in the metrics file. skipped is the number
+    of units that need no call. Repair calls cannot be known in advance and
+    are not included.
+    """
+    prompt_tokens = sum(estimate_tokens(system_message + prompt) for prompt in prompts)
+    print(f"Plan for {stage}: {len(prompts)} LLM calls, ~{prompt_tokens} prompt tokens ({skipped} units need no call)")
+    records = []
+    if args.metrics_file and os.path.exists(args.metrics_file):
+        records = [r for r in telemetry.read_metrics([args.metrics_file]) if r['stage'] == stage and r.get('model') == args.model_name]
+    seconds = telemetry.project_seconds(records, len(prompts), prompt_tokens)
+    if seconds is None:
+        print(f"  No recorded {args.model_name} calls for {stage} in '{args.metrics_file}', run the stage once to project the wall time")
+        return
+    print(f"  Projected wall time: {seconds / 60:.1f} min with one request at a time, {seconds / 60 / args.concurrency:.1f} min at --concurrency {args.concurrency} if the server scales")
+
+
+# Result of a job deferred to the next pass of a scheduled cascade
+DEFERRED = object()
+
+
+def iter_jobs(worker, jobs, concurrency=1, checkpoint=None, cascade=None):
+    """
+    Function to run worker over each job with up to `concurrency` jobs in
+    flight at once, yielding the results in the same order as the jobs as
+    soon as they are ready, so the output does not depend on which requests
+    finish first and can be written while later jobs are still running.
+    If a checkpoint is supplied, jobs it already holds are not run again and
+    each new result is recorded in it as soon as the job finishes. Jobs are
+    submitted at most 2 * concurrency ahead of the result being yielded, so
+    jobs can be a generator and the queue does not grow with their number.
+    If the cascade has a model scheduler (--schedule_models), the jobs are
+    run in passes that each ask one model, see ModelScheduler. The results
+    after the first deferred job are then held until it is done.
+    """
+    scheduler = cascade.scheduler if cascade is not None else None
+
+    def run(job):
+        if checkpoint is not None and checkpoint.done(job):
+            return checkpoint.get(job)
+        # Calls made for this job are recorded against it
+        with telemetry.call_context(unit=job):
+            try:
+                result = worker(job)
+            except ModelDeferred:
+                # The job is run again in the next pass, which counts its escalations
+                cascade.forget(job)
+                return DEFERRED
+        if checkpoint is not None:
+            checkpoint.append(job, result)
+        return result
+
+    def run_all(jobs):
+        if concurrency <= 1:
+            for job in jobs:
+                yield run(job)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                pending = deque()
+                for job in jobs:
+                    pending.append(executor.submit(run, job))
+                    if len(pending) >= 2 * concurrency:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+
+    if scheduler is None:
+        yield from run_all(jobs)
+        return
+    jobs = list(jobs)
+    results = {}
+    next_index = 0
+    pending = list(range(len(jobs)))
+    # The small model is asked first, then the models take turns
+    model = scheduler.small_model
+    while pending:
+        scheduler.start_pass(model)
+        for index, result in zip(pending, run_all([jobs[index] for index in pending])):
+            results[index] = result
+            # Yield the results that are ready, keeping the jobs in order
+            while results.get(next_index, DEFERRED) is not DEFERRED:
+                yield results.pop(next_index)
+                next_index += 1
+        pending = [index for index in pending if results.get(index) is DEFERRED]
+        model = scheduler.large_model if model == scheduler.small_model else scheduler.small_model
+    scheduler.finish()
+
+
+def run_jobs(worker, jobs, concurrency=1, checkpoint=None, cascade=None):
+    """
+    Function to run worker over each job with up to `concurrency` jobs in
+    flight at once. Results are returned in the same order as the jobs.
+    See iter_jobs.
+    """
+    return list(iter_jobs(worker, jobs, concurrency, checkpoint, cascade))
+
+
+class RowWriter:
+    """
+    Writer appending output rows to a JSON lines file as they are produced,
+    so memory stays flat whatever the number of taxa. Every row has the same
+    columns, in a fixed order, and the values are written as they are, with
+    None for nulls. to_csv converts the rows to the CSV file the rest of the
+    pipeline reads.
+    """
+
+    def __init__(self, path, columns, chunk_rows=10000):
+        self.path = path
+        self.columns = list(columns)
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def write(self, row):
+        """
+        Function to append a row. Missing columns are null and columns not
+        in the schema are left out.
+        """
+        record = {column: row.get(column) for column in self.columns}
+        # Values JSON cannot hold (e.g. numpy numbers) are written as text
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        self.rows += 1
+
+    def to_csv(self, csv_path):
+        """
+        Function to convert the rows to a CSV file with pandas, a chunk of
+        rows at a time, and remove the JSON lines file. The columns are kept
+        as objects, so every chunk is written the same way and nulls are
+        empty fields.
+        """
+        self._file.close()
+
+        def write_chunk(records, header):
+            chunk = pd.DataFrame(records, columns=self.columns, dtype=object)
+            chunk.to_csv(csv_path, mode='w' if header else 'a', header=header, index=False)
+
+        with open(self.path, 'r', encoding='utf-8') as file_in:
+            records = []
+            header = True
+            for line in file_in:
+                records.append(json.loads(line))
+                if len(records) == self.chunk_rows:
+                    write_chunk(records, header)
+                    records = []
+                    header = False
+            if records or header:
+                write_chunk(records, header)
+        os.remove(self.path)
+
+
+def llm_chat(llm_client, model_name,system_mesage, prompt, cache=None, prompt_version='', format=None):
+    """
+    Function to generate a description using the model served by llm_client
+    (one of the backends in scripts/backends.py).
+    If a cache is supplied, a request that has been made before is answered
+    from the cache instead of being sent to the model. prompt_version is a
+    salt for the prompt template, bump it to invalidate old responses.
+    format is passed on to the backend to constrain the output, e.g. a JSON schema.
+    """
+    options = {"temperature": 0}
+    start = time.perf_counter()
+    if cache is not None:
+        key = cache.make_key(model_name, system_mesage, prompt, options, prompt_version, format)
+        output = cache.get(key)
+        if output is not None:
+            telemetry.record(model=model_name, prompt_version=prompt_version, cache='hit', wall_time=time.perf_counter() - start)
+            return output
+    try:
+        chat_completion = llm_client.chat(
+            model=model_name,
+            messages=[
+                {"role": "system", "content": system_mesage},
+                {"role": "user", "content": prompt}
+            ],
+            options=options,
+            format=format
+        )
+    except ModelDeferred:
+        # Not an error, the call is made in the next pass (see ModelScheduler)
+        raise
+    except Exception as e:
+        telemetry.record(model=model_name, prompt_version=prompt_version, error=str(e), wall_time=time.perf_counter() - start)
+        raise
+    output = chat_completion['message']['content']
+    # Keep Ollama's token counts and durations for the performance report
+    telemetry.record(
         model=model_name,
-        messages=[
-            {"role": "system", "content": system_mesage},
-            {"role": "user", "content": prompt}
-        ],
-        options={"temperature": 0}
+        prompt_version=prompt_version,
+        cache='replay' if chat_completion.get('replayed') else 'off' if cache is None else 'miss',
+        wall_time=time.perf_counter() - start,
+        **{field: chat_completion.get(field) for field in telemetry.RESPONSE_FIELDS},
     )
-    return chat_completion['message']['content']
+    if cache is not None:
+        cache.put(key, model_name, prompt_version, output)
+    return output
+
+
+def read_table(source):
+    """
+    Function to read a CSV file into a DataFrame. A DataFrame that is
+    already in memory (e.g. passed on by run_pipeline) is copied instead.
+    """
+    if isinstance(source, pd.DataFrame):
+        return source.copy()
+    return pd.read_csv(source)
+
 
+def to_records_json(records):
+    """
+    Function to write a list of values or dicts as compact JSON, the same
+    way as pandas' to_json(orient='records'), so prompts built from the
+    indexes below are unchanged.
+    """
+    def clean(value):
+        # pandas writes missing values as null
+        if isinstance(value, float) and math.isnan(value):
+            return None
+        if isinstance(value, dict):
+            return {key: clean(item) for key, item in value.items()}
+        return value
+
+    return json.dumps([clean(record) for record in records], separators=(',', ':')).replace('/', '\\/')
 
-def get_supp_codes(tidy_supp_data, code, taxon_name):
+
+class SuppDataIndex:
     """
-    Function to get the code and value from the tidy supplementary data
-    for a specific taxon name.
+    The supplementary data indexed once by (taxon_name, code), so the
+    description scripts look up a value, or the multi-value rows of a
+    code, with a dictionary access instead of filtering the whole table.
     """
-    return tidy_supp_data[
-        (tidy_supp_data.code == code) &
-        (tidy_supp_data.taxon_name == taxon_name)
-    ][["code", "value"]].to_json(orient='records')
+
+    def __init__(self, tidy_supp_data, multi_qual=None):
+        self.values = dict(zip(zip(tidy_supp_data.taxon_name, tidy_supp_data.code), tidy_supp_data.value))
+        self.multi_rows = {}
+        if multi_qual is not None:
+            for row in multi_qual.to_dict(orient='records'):
+                # Missing values are None, as they would be after a JSON round-trip
+                row = {key: None if isinstance(value, float) and math.isnan(value) else value for key, value in row.items()}
+                self.multi_rows.setdefault((row['taxon_name'], row['code']), []).append(row)
+
+    def value(self, taxon_name, code, default=''):
+        """
+        Function to get the value of a code for a taxon.
+        """
+        return self.values.get((taxon_name, code), default)
+
+    def supp_codes(self, taxon_name, code):
+        """
+        Function to get the code and value of a taxon as a JSON string, e.g.
+        '[{"code":"petiole","value":"10.5(4.0-17.0)"}]'. Empty if the taxon
+        has no row for the code.
+        """
+        if (taxon_name, code) not in self.values:
+            return to_records_json([])
+        return to_records_json([{"code": code, "value": self.values[(taxon_name, code)]}])
+
+    def multi(self, taxon_name, code):
+        """
+        Function to get the multi-value rows of a code for a taxon, as dicts.
+        """
+        return self.multi_rows.get((taxon_name, code), [])
 
 
 def append_output(output_list, taxon_name, output, subject):
@@ -40,10 +311,149 @@ def append_output(output_list, taxon_name, output, subject):
     output_list.append(loop_dict)
 
 
-def check_valid_json(output, taxon_dict):
+def estimate_tokens(text):
+    """
+    Function to estimate the number of tokens in a piece of text.
+    Uses the rule of thumb of about four characters per token.
+    """
+    return math.ceil(len(text) / 4)
+
+
+def make_batches(items, fixed_tokens, token_budget):
+    """
+    Function to split a list of appendix items (dicts with a "code" key)
+    into batches so that each prompt stays within token_budget.
+    fixed_tokens is the size of the prompt without any items in it.
+    Every batch holds at least one item.
+    """
+    batches = []
+    batch = []
+    batch_tokens = fixed_tokens
+    for item in items:
+        item_tokens = estimate_tokens(json.dumps(item))
+        if batch and batch_tokens + item_tokens > token_budget:
+            batches.append(batch)
+            batch = []
+            batch_tokens = fixed_tokens
+        batch.append(item)
+        batch_tokens += item_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def parse_json_output(output):
+    """
+    Function to parse the JSON object in an LLM output. If the output is not
+    valid JSON on its own (e.g. chain-of-thought answers), the last JSON
+    object in the text is used. Returns None if no JSON object is found.
+    """
     try:
-        sentence_dict = json.loads(output)
-        taxon_dict.update(sentence_dict)
-    except Exception as e:
-        logging.error(f"Failed to parse JSON {output} | Error: {e}")
-    return taxon_dict
\ No newline at end of file
+        parsed = json.loads(output)
+        if isinstance(parsed, dict):
+            return parsed
+    except json.JSONDecodeError:
+        pass
+    for candidate in reversed(re.findall(r'\{[^{}]*\}', output)):
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    logging.error(f"Failed to parse JSON {output}")
+    return None
+
+
+def build_json_schema(codes):
+    """
+    Function to build a JSON schema for an object with one required key per
+    code, each holding a string or null. Passed to Ollama's format parameter
+    so the model can only answer with the requested keys.
+    """
+    return {
+        "type": "object",
+        "properties": {
+            code: {"anyOf": [{"type": "string"}, {"type": "null"}]}
+            for code in codes
+        },
+        "required": list(codes),
+    }
+
+
+class ExtractionStats:
+    """
+    Counters of invalid model outputs and repair calls made while extracting
+    traits, shared between worker threads.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.repair_calls = 0
+        self.invalid_outputs = 0
+        self.codes_requested = 0
+        self.invalid_codes = 0
+        self.unresolved_codes = 0
+        self._lock = threading.Lock()
+
+    def record_call(self, repair, num_codes, parsed, num_invalid):
+        """
+        Function to record the outcome of a single extraction call.
+        """
+        with self._lock:
+            self.calls += 1
+            self.repair_calls += int(repair)
+            self.invalid_outputs += int(not parsed)
+            self.codes_requested += num_codes
+            self.invalid_codes += num_invalid
+
+    def record_unresolved(self, num_codes):
+        """
+        Function to record codes that had no valid value after all repairs.
+        """
+        with self._lock:
+            self.unresolved_codes += num_codes
+
+    def report(self):
+        """
+        Function to print the invalid-output rates and number of repair calls.
+        """
+        calls = max(self.calls, 1)
+        codes = max(self.codes_requested, 1)
+        print(
+            f"Extraction: {self.calls} calls ({self.repair_calls} repair calls), "
+            f"{self.invalid_outputs} unparseable outputs ({self.invalid_outputs / calls:.1%}), "
+            f"{self.invalid_codes} missing or invalid values ({self.invalid_codes / codes:.1%}), "
+            f"{self.unresolved_codes} codes left unresolved"
+        )
+
+
+def extract_batch(ask, batch, validate=None, stats=None, repair=False):
+    """
+    Function to extract the values for a batch of appendix items.
+    ask(batch) sends the prompt for the batch and returns the model output.
+    validate(value) returns False for values that are not acceptable.
+    If the JSON is invalid, or some codes are missing or invalid, only those
+    items are asked again, split in half each time, down to single codes.
+    """
+    codes = [item['code'] for item in batch]
+    with telemetry.call_context(codes=codes, repair=repair):
+        output = ask(batch)
+    parsed = parse_json_output(output)
+    result = {
+        code: parsed[code] for code in codes
+        if parsed is not None and code in parsed
+        and (validate is None or validate(parsed[code]))
+    }
+    missing = [item for item in batch if item['code'] not in result]
+    if stats is not None:
+        stats.record_call(repair, len(codes), parsed is not None, len(missing))
+    if missing and len(batch) == 1:
+        logging.error(f"No valid value returned for {codes}")
+        if stats is not None:
+            stats.record_unresolved(len(missing))
+    elif missing:
+        middle = (len(missing) + 1) // 2
+        for half in (missing[:middle], missing[middle:]):
+            if half:
+                result.update(extract_batch(ask, half, validate, stats, repair=True))
+    # Keep the codes in appendix order
+    return {code: result[code] for code in codes if code in result}
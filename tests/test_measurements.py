@@ -0,0 +1,23 @@
+from scripts.trait_extraction.measurements import extract_measurements
+
+
+def test_reads_mean_min_max_measurements():
+    text = "Stems 3.3(1.8–4.5) cm diameter; pinnae 14(12–16) per side of rachis. Fruits 1.4 cm long"
+    found = extract_measurements(text, ['stemdiameter', 'numpin', 'fruitlen'])
+    assert {code: value for code, (value, _) in found.items()} == {
+        'stemdiameter': '3.3(1.8-4.5) cm',
+        'numpin': '14(12-16)',
+        'fruitlen': '1.4 cm',
+    }
+
+
+def test_leaves_plain_ranges_to_the_llm():
+    text = "Stems to 15 m long, 1–2 cm diameter. pinnae 12–15 per side of rachis; fruits 1.2-1.5 cm long"
+    found = extract_measurements(text, ['stemdiameter', 'numpin', 'fruitlen'])
+    assert found == {}
+
+
+def test_leaves_upper_bounds_to_the_llm():
+    text = "Stems to 15 m long, 3.3(1.8–4.5) cm diameter; petioles up to 20 cm long"
+    found = extract_measurements(text, ['stemlength', 'stemdiameter', 'petiole'])
+    assert {code: value for code, (value, _) in found.items()} == {'stemdiameter': '3.3(1.8-4.5) cm'}
@@ -0,0 +1,90 @@
+import os
+import pandas as pd
+import pytest
+from scripts.description_generation import app1_descriptions, app2_descriptions, combine_descriptions
+from scripts.trait_extraction import app1_extraction
+from scripts.trait_extraction.app2_extraction import get_prompt_outline
+from scripts.trait_extraction.prompts import PROMPT_VERSIONS
+from scripts.utils import SuppDataIndex
+
+
+def assert_shared_prefix(first, second, prefix):
+    """
+    Function to check that two prompts built from different inputs differ,
+    but both start with the whole static prefix.
+    """
+    assert first != second
+    assert prefix.strip()
+    assert os.path.commonprefix([first, second]).startswith(prefix)
+
+
+def static_part(template, field):
+    """
+    Function to get the part of a str.format template before its first field.
+    """
+    return template.split('{' + field + '}')[0].format()
+
+
+def test_app1_extraction_prompt():
+    first = app1_extraction.build_prompt("Stems 3.3(1.8–4.5) cm diameter.", [{"code": "stemdiameter", "description": "Stem diameter"}])
+    second = app1_extraction.build_prompt("Fruits 1.4 cm long.", [{"code": "fruitlen", "description": "Fruit length"}])
+    assert_shared_prefix(first, second, app1_extraction.PROMPT_PREFIX)
+
+
+@pytest.mark.parametrize('prompt_style', list(PROMPT_VERSIONS))
+def test_app2_extraction_prompts(prompt_style):
+    outline = get_prompt_outline(prompt_style)
+    first = outline.format(subject_para="Stems clustered.", appendix_2_subject_batch=[{"code": "solclu", "rules": "Stems solitary (0); stems clustered (1)"}])
+    second = outline.format(subject_para="Seeds 1 per fruit.", appendix_2_subject_batch=[{"code": "seeded", "rules": "Seeds 1 per fruit (0); seeds 2-3 per fruit (1)"}])
+    assert_shared_prefix(first, second, static_part(outline, 'appendix_2_subject_batch'))
+
+
+def test_app1_descriptions_prompt():
+    df_app1 = pd.DataFrame({
+        'code': ['petiole', 'fruitlen'],
+        'description': ['Petiole length', 'Fruit length'],
+        'unit': ['cm', 'mm'],
+    })
+    tidy_supp_data = pd.DataFrame({
+        'taxon_name': ['Calamus concolor', 'Calamus disjunctus'],
+        'code': ['petiole', 'fruitlen'],
+        'value': ['10.5(4.0-17.0)', '14.2(12.0-16.1)'],
+    })
+    traits = app1_descriptions.index_traits(df_app1)
+    supp_index = SuppDataIndex(tidy_supp_data)
+    first = app1_descriptions.build_prompt(traits, supp_index, 'Calamus concolor', 'petiole')
+    second = app1_descriptions.build_prompt(traits, supp_index, 'Calamus disjunctus', 'fruitlen')
+    assert_shared_prefix(first, second, app1_descriptions.PROMPT_PREFIX)
+
+
+def test_app2_descriptions_prompts():
+    df_app2 = pd.DataFrame({
+        'code': ['solclu', 'seeded'],
+        'rules': ['Stems solitary (0); stems clustered (1)', 'Seeds 1 per fruit (0); seeds 2-3 per fruit (1)'],
+    })
+    multi_qual = pd.DataFrame({
+        'taxon_name': ['Calamus concolor', 'Calamus disjunctus'],
+        'code': ['solclu', 'seeded'],
+        'value': [1, 0],
+        'frequency': [3, 5],
+        'num_specimens': [4, 6],
+        'num_specimens_scored': [4, 6],
+        'other_values': ['0', '1'],
+    })
+    rules = app2_descriptions.index_rules(df_app2)
+    supp_index = SuppDataIndex(pd.DataFrame(columns=['taxon_name', 'code', 'value']), multi_qual)
+    first = app2_descriptions.build_multi_prompt(rules, supp_index, 'Calamus concolor', 'solclu')
+    second = app2_descriptions.build_multi_prompt(rules, supp_index, 'Calamus disjunctus', 'seeded')
+    assert_shared_prefix(first, second, app2_descriptions.MULTI_VAL_PROMPT_PREFIX)
+    first = app2_descriptions.build_single_prompt(rules, 'solclu', '1')
+    second = app2_descriptions.build_single_prompt(rules, 'seeded', '0')
+    assert_shared_prefix(first, second, app2_descriptions.SINGLE_VAL_PROMPT_PREFIX)
+
+
+def test_combine_descriptions_prompts():
+    first = combine_descriptions.build_prompt('["Stems clustered.", "Stems 3.3 cm diameter."]')
+    second = combine_descriptions.build_prompt('["Fruits 1.4 cm long.", "Fruits brown."]')
+    assert_shared_prefix(first, second, static_part(combine_descriptions.PROMPT, 'sentences'))
+    first = combine_descriptions.build_taxon_prompt({"Stem": ["Stems clustered.", "Stems 3.3 cm diameter."]})
+    second = combine_descriptions.build_taxon_prompt({"Fruit": ["Fruits 1.4 cm long.", "Fruits brown."]})
+    assert_shared_prefix(first, second, static_part(combine_descriptions.TAXON_PROMPT, 'subjects'))